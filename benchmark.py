@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import sys, os, time, json, shutil, tempfile, runpy
+from optparse import OptionParser
+
+description = """
+Offline benchmark of publish, bulk, check and inject workflows. The tools are
+executed as they are, but against local stand-ins of DBS, PhEDEx and
+file access (see mock_services.py) with configurable latencies. For
+every size the number of datasets (check, inject) or files (publish,
+bulk) is set to that size and wall time, throughput and timing of remote
+operations are reported.
+"""
+parser = OptionParser(usage = "\n\t%prog [options]", description = description, epilog= ' ')
+parser.add_option("-s", "--sizes", dest="sizes", metavar="LIST", default="10,100,1000,10000,50000",
+                  help="Comma separated list of numbers of datasets/files. Default: %default")
+parser.add_option("-w", "--workflows", dest="workflows", metavar="LIST", default="publish,check,inject",
+                  help="Comma separated list of workflows to run. Default: %default")
+parser.add_option("--files-per-dataset", dest="files_per_dataset", metavar="N", type="int", default=100,
+                  help="Number of files per dataset in the bulk publication workflow. Default: %default")
+parser.add_option("--dbs-latency", dest="dbs_latency", metavar="SECONDS", type="float", default=0.01,
+                  help="Time of each DBS call. Default: %default")
+parser.add_option("--phedex-latency", dest="phedex_latency", metavar="SECONDS", type="float", default=0.02,
+                  help="Time of each PhEDEx request. Default: %default")
+parser.add_option("--open-latency", dest="open_latency", metavar="SECONDS", type="float", default=0.01,
+                  help="Time to open a file. Default: %default")
+parser.add_option("--stat-latency", dest="stat_latency", metavar="SECONDS", type="float", default=0.002,
+                  help="Time to stat a file. Default: %default")
+parser.add_option("-j", "--jobs", dest="jobs", metavar="N", type="int", default=4,
+                  help="Value of --jobs passed to the tools. Default: %default")
+parser.add_option("--rate-limit", dest="rate_limit", metavar="N", type="float", default=0,
+                  help="Value of --rate-limit passed to the tools. Default: %default (no limit)")
+parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                  help="Store results in JSON format")
+parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                  help="Show output of the tools")
+
+(options, args) = parser.parse_args()
+
+tool_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, tool_directory)
+import mock_services
+
+def run_tool(script, argv, world, workdir):
+     """Run a tool in a forked process with stand-ins installed. Returns
+     (exit code, wall time, metrics of remote operations)"""
+     metrics_file = os.path.join(workdir, "metrics.json")
+     argv = argv + ["--metrics", metrics_file, "--rate-limit", str(options.rate_limit)]
+     start = time.time()
+     pid = os.fork()
+     if pid == 0:
+          exit_code = 0
+          try:
+               os.chdir(workdir)
+               if not options.verbose:
+                    devnull = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(devnull, 1)
+                    os.dup2(devnull, 2)
+               sys.modules.update(mock_services.install_fake_dbs(world, options.dbs_latency))
+               sys.modules['ROOT'] = mock_services.fake_root(world, options.open_latency)
+               import storage
+               mock_services.SyntheticStorage.world = world
+               mock_services.SyntheticStorage.latency = options.stat_latency
+               storage.XRootDStorage = mock_services.SyntheticStorage
+               sys.argv = [script] + argv
+               runpy.run_path(os.path.join(tool_directory, script), run_name="__main__")
+          except SystemExit, e:
+               if e.code: exit_code = e.code if isinstance(e.code, int) else 1
+          except:
+               import traceback
+               traceback.print_exc()
+               exit_code = 1
+          import instrumentation
+          instrumentation.finish()
+          sys.stdout.flush()
+          os._exit(exit_code)
+     pid, status = os.waitpid(pid, 0)
+     wall = time.time() - start
+     metrics = dict()
+     if os.path.exists(metrics_file):
+          with open(metrics_file) as f:
+               metrics = json.load(f)['operations']
+     return os.WEXITSTATUS(status), wall, metrics
+
+def benchmark_publish(size, workdir, phedex_server):
+     world = mock_services.SyntheticWorld(nDatasets=0, nFiles=size)
+     filelist = os.path.join(workdir, "files.txt")
+     with open(filelist, 'w') as f:
+          for lfn in world.files:
+               f.write(lfn + "\n")
+     argv = ["-f", filelist, "--publish", "--no-cache", "--jobs", str(options.jobs),
+             "--journal", os.path.join(workdir, "publish.journal")]
+     exit_code, wall, metrics = run_tool("publish_dataset.py", argv, world, workdir)
+     return exit_code, wall, size, metrics
+
+def benchmark_bulk(size, workdir, phedex_server):
+     """Publication of many datasets in one run driven by a manifest"""
+     world = mock_services.SyntheticWorld(nDatasets=0, nFiles=size)
+     manifest = os.path.join(workdir, "manifest.txt")
+     with open(manifest, 'w') as f:
+          for i, lfn in enumerate(world.files):
+               f.write("SyntheticLHE%06d %s\n" % (i/options.files_per_dataset, lfn))
+     argv = ["--manifest", manifest, "--publish", "--no-cache", "--jobs", str(options.jobs),
+             "--upload-jobs", str(options.jobs), "--journal", os.path.join(workdir, "publish.journal")]
+     exit_code, wall, metrics = run_tool("publish_dataset.py", argv, world, workdir)
+     return exit_code, wall, size, metrics
+
+def benchmark_check(size, workdir, phedex_server):
+     world = mock_services.SyntheticWorld(nDatasets=size, nFiles=0)
+     phedex_server.world = world
+     os.mkdir(os.path.join(workdir, "reports"))
+     argv = ["--era", world.era, "--tier", "AOD,MINIAOD", "--ignore", "0",
+             "--proxy", phedex_server.certificate, "--phedex-url", phedex_server.url]
+     exit_code, wall, metrics = run_tool("check_data_availability.py", argv, world, workdir)
+     return exit_code, wall, size, metrics
+
+def benchmark_inject(size, workdir, phedex_server):
+     world = mock_services.SyntheticWorld(nDatasets=size, nFiles=0)
+     phedex_server.world = world
+     argv = ["--era", world.era, "--tier", "AOD,MINIAOD", "--phedex", "--injector", "true",
+             "--jobs", str(options.jobs), "--proxy", phedex_server.certificate, "--phedex-url", phedex_server.url]
+     exit_code, wall, metrics = run_tool("inject_data_in_DDM.py", argv, world, workdir)
+     return exit_code, wall, size, metrics
+
+workflows = {'publish': benchmark_publish,
+             'bulk':    benchmark_bulk,
+             'check':   benchmark_check,
+             'inject':  benchmark_inject}
+
+phedex_server = mock_services.PhedexServer(mock_services.SyntheticWorld(0, 0), options.phedex_latency)
+phedex_server.start()
+
+results = []
+print "%-10s %10s %12s %16s %6s" % ("workflow", "size", "wall [s]", "items/s", "status")
+try:
+     for workflow in options.workflows.split(','):
+          for size in [int(x) for x in options.sizes.split(',')]:
+               workdir = tempfile.mkdtemp(prefix="benchmark_%s" % workflow)
+               try:
+                    exit_code, wall, nItems, metrics = workflows[workflow](size, workdir, phedex_server)
+               finally:
+                    shutil.rmtree(workdir)
+               throughput = nItems/wall if wall > 0 else 0
+               print "%-10s %10d %12.2f %16.1f %6s" % (workflow, size, wall, throughput, "ok" if exit_code==0 else "failed")
+               if options.verbose:
+                    for operation, stats in sorted(metrics.items()):
+                         print "%30s %8d calls %6d errors %10.2f s" % (operation, stats['count'], stats['errors'], stats['total_time'])
+               sys.stdout.flush()
+               results.append({'workflow':workflow, 'size':size, 'wall':wall,
+                               'throughput':throughput, 'exit_code':exit_code,
+                               'operations':metrics})
+finally:
+     phedex_server.stop()
+     shutil.rmtree(phedex_server.directory)
+
+if options.output:
+     with open(options.output, 'w') as f:
+          json.dump({'options':options.__dict__, 'results':results}, f, indent=2)
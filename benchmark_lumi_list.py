@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+import sys, time
+from optparse import OptionParser
+
+description = """
+Compare columnar and entry by entry reading of LuminosityBlocks tree.
+Both methods must produce identical file_lumi_list for DBS.
+"""
+parser = OptionParser(usage = "\n\t%prog [options] LFN [LFN ...]", description = description, epilog= ' ')
+parser.add_option("-n", "--repeat", dest="repeat", metavar="N", type="int", default=3,
+                  help="Number of times each measurement is repeated. Default: %default")
+parser.add_option("--local", dest="local", metavar="DIR",
+                  help="Read files from a local directory DIR/<lfn> instead of xrootd.")
+
+(options, args) = parser.parse_args()
+
+if len(args)==0:
+     parser.print_help()
+     sys.exit(1)
+
+sys.argv = [] # clear up list of arguments to avoid confusing ROOT
+import ROOT, file_probe, storage
+
+if options.local:
+     file_storage = storage.PosixStorage(options.local)
+else:
+     file_storage = storage.XRootDStorage()
+
+def measure(method, tree):
+     best = None
+     result = None
+     for i in range(options.repeat):
+          start = time.time()
+          result = method(tree)
+          elapsed = time.time() - start
+          if best == None or elapsed < best:
+               best = elapsed
+     return best, result
+
+for lfn in args:
+     try:
+          f, url = file_probe.open_file(lfn, file_storage)
+     except Exception, e:
+          print e
+          continue
+     tree = f.Get("LuminosityBlocks")
+     t_loop, loop_lumis = measure(file_probe.get_run_lumi_list_loop, tree)
+     t_columnar, columnar_lumis = measure(file_probe.get_run_lumi_list, tree)
+     same = file_probe.get_dbs_lumi_list(loop_lumis) == file_probe.get_dbs_lumi_list(columnar_lumis)
+     print "%s: %d lumis" % (lfn, len(loop_lumis))
+     print "\tloop:     %0.4f sec" % t_loop
+     print "\tcolumnar: %0.4f sec (x%0.1f)" % (t_columnar, t_loop/t_columnar if t_columnar > 0 else 0)
+     print "\tidentical output: %s" % same
+     f.Close()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
-import  sys, time, json, urllib2, subprocess, pprint, re, pycurl
+import  sys, time, json, urllib2, subprocess, pprint, re, threading
 from dbs.apis.dbsClient import DbsApi
+import http_client, dbs_tools, instrumentation, governor, snapshot_store, phedex as phedex_api
+import pipeline as pipeline_module, dataset_report as dataset_report_module
 
 from optparse import OptionParser
-from StringIO import StringIO    
 from ast import literal_eval
 
 description = """
@@ -15,24 +16,67 @@ information in PhEDEx.
 parser = OptionParser(usage = "\n\t%prog [options]", description = description, epilog= ' ')
 parser.add_option("-t", "--tier", dest="tiers", metavar="LIST",
                   help="comma separated list of data tiers without whitespaces.")
-parser.add_option("-r", "--run", dest="run", metavar="NUMBER",
-                  help="run number")
+parser.add_option("-r", "--run", dest="run", metavar="LIST",
+                  help="comma separated list of run numbers")
 parser.add_option("-e", "--era", dest="era", metavar="TEXT",
-                  help="Look for all datasets corresponding to a given production Era. Example: 'Run2015C'")
-parser.add_option("-i", "--ignore", dest="ignore", metavar="NUMBER",
+                  help="Look for all datasets corresponding to given production Eras (comma separated list). Example: 'Run2015C,Run2015D'. Datasets matching any of the runs and eras are checked once.")
+parser.add_option("-i", "--ignore", dest="ignore", metavar="NUMBER", type="float",
                   default = 7,
                   help="Ignore datasets that had the first subscription request with last N days. Default: %default") 
-parser.add_option("-l", "--lost", dest="lost_fraction", metavar = "NUMBER",
+parser.add_option("-l", "--lost", dest="lost_fraction", metavar = "NUMBER", type="float",
                   default = 90,
                   help="Fraction of the original dataset size that defines a threashold of what we call lost dataset. Default: %default")
 
+parser.add_option("--proxy", dest="proxy", metavar="FILE",
+                  default = "/tmp/x509up_u11792",
+                  help="Grid proxy used to access PhEDEx. Default: %default")
+parser.add_option("--phedex-url", dest="phedex_url", metavar="URL",
+                  default = phedex_api.default_url,
+                  help="PhEDEx data service. Default: %default")
+parser.add_option("--connections", dest="connections", metavar="NUMBER", type="int",
+                  default = 10,
+                  help="Maximum number of concurrent PhEDEx requests. Default: %default")
+parser.add_option("--phedex-chunk", dest="phedex_chunk", metavar="NUMBER", type="int",
+                  default = 25,
+                  help="Number of datasets per PhEDEx request. Default: %default")
+parser.add_option("--incremental", dest="incremental", action="store_true", default=False,
+                  help="Check only datasets that are new, modified in DBS or had problems according to the previous snapshot.")
+parser.add_option("--max-age", dest="max_age", metavar="DAYS", type="float",
+                  default = 7,
+                  help="In incremental mode recheck datasets without problems if they were checked more than DAYS ago. Default: %default")
+parser.add_option("--dbs-jobs", dest="dbs_jobs", metavar="NUMBER", type="int",
+                  default = 10,
+                  help="Number of concurrent DBS requests for dataset sizes. Default: %default")
+parser.add_option("--report", dest="report", metavar="FILE",
+                  help="Per-dataset report in JSON Lines format, or CSV if FILE ends with .csv. Default: reports/consistency_check-[period]-[date]-[tiers].jsonl")
+parser.add_option("--shard", dest="shard", metavar="i/N",
+                  help="Process only shard i (counting from 0) of N. Datasets are assigned to shards by a hash of their names, so N jobs with i=0..N-1 cover every dataset exactly once.")
+instrumentation.add_options(parser)
+governor.add_options(parser)
+
 (options, args) = parser.parse_args()
+instrumentation.setup(options)
+governor.setup(options)
+
+shard = None
+if options.shard:
+     try:
+          shard = dbs_tools.parse_shard(options.shard)
+     except ValueError, e:
+          print "ERROR: %s" % e
+          sys.exit(1)
+
+if options.connections < 1:
+     print "ERROR: --connections must be at least 1"
+     sys.exit(1)
 
-proxyCertificate = "/tmp/x509up_u11792"
+proxyCertificate = options.proxy
 capath = "/etc/grid-security/certificates"
+phedex = http_client.HttpClient(proxyCertificate, capath, max_connections=options.connections,
+                                 operation="phedex", governor=governor.get(options.phedex_url))
 
 if not options.run and not options.era:
-     print "ERROR: need either RUN number or Era name specified"
+     print "ERROR: need either RUN numbers or Era names specified"
      parser.print_help()
      sys.exit(1)
 
@@ -46,22 +90,37 @@ if options.tiers:
      datatiers = options.tiers.split(',')
 
 tiers = re.sub(',',"_",options.tiers)
-period = None
-if options.run: period = options.run
-if options.era: period = options.era
+runs = dbs_tools.split_list(options.run)
+eras = dbs_tools.split_list(options.era)
+period = dbs_tools.get_period_name(runs, eras)
 logfile_prefix = "reports/consistency_check-%s-%s-%s" % (
      period, 
      time.strftime("%Y-%m-%d", time.localtime()),
      tiers)
+shard_suffix = ""
+if shard:
+     shard_suffix = "-shard%dof%d" % shard
+     logfile_prefix += shard_suffix
 logfile = logfile_prefix+".log"
 log = open(logfile, 'w')
 
+# results of previous checks of the same period and tiers
+snapshot = snapshot_store.SnapshotStore("reports/snapshot-%s-%s%s.db" % (period, tiers, shard_suffix))
+previous_snapshot = snapshot.load()
+
 summary = {"NotInPhedex":[],
            "NoCompleteCopyAnywhere":[],
            "NoCompleteCopyAnalysisOps":[],
            "Lost":[]
            }
 
+# Per-dataset records are written as soon as a dataset is checked. Lists
+# of datasets with problems are produced from the same records.
+report_fields = ['dataset', 'size', 'status', 'PhEDEx', 'nComplete', 'nIncomplete',
+                 'nAnalysisOpsComplete', 'firstSubscription']
+dataset_report = dataset_report_module.DatasetReport(options.report or logfile_prefix+".jsonl", report_fields,
+                                                     dataset_report_module.get_availability_lists(logfile_prefix, options.lost_fraction))
+
 def form_subscription_report(subscription):
      return "node: %-20s fraction: %-3s%%  custodial: %1s group %-20s" % (
           subscription['node'],subscription['percent_bytes'],subscription['custodial'],subscription['group'])
@@ -79,35 +138,16 @@ def get_availability(percentage):
      return availability
 
 
-def get_subscription_information(dataset):
-     report = {'nComplete':0,'PhEDEx':False,'nAnalysisOpsComplete':0,'nIncomplete':0,'firstSubscription':None}
-     storage = StringIO()
-     curl = pycurl.Curl()
-     url = "https://cmsweb.cern.ch/phedex/datasvc/json/prod/subscriptions?dataset=%s" % dataset
-     # print url
-     curl.setopt(pycurl.URL, str(url))
-     curl.setopt(pycurl.SSL_VERIFYPEER, 1)
-     curl.setopt(pycurl.SSL_VERIFYHOST, 2)
-     curl.setopt(pycurl.CAINFO, proxyCertificate)
-     curl.setopt(pycurl.CAPATH, capath)
-     curl.setopt(pycurl.SSLKEY, proxyCertificate)
-     curl.setopt(pycurl.SSLCERT, proxyCertificate)
-     curl.setopt(curl.WRITEFUNCTION, storage.write)
-     curl.perform()
-     # make a dictitionary out of the json
-     data = json.loads(storage.getvalue())
-     # pprint.pprint(data)
+def new_report():
+     return {'nComplete':0,'PhEDEx':False,'nAnalysisOpsComplete':0,'nIncomplete':0,'firstSubscription':None,'log':[]}
+
+def get_subscription_information(record):
+     """Classify subscriptions of a PhEDEx dataset record as soon as it's
+     parsed. Only the counts and the log lines are kept."""
+     report = new_report()
      try:
-          datasets = data['phedex']['dataset']
-          if len(datasets)==0:
-               summary["NotInPhedex"].append(dataset)
-               print >>log, "No information in PhEDEx about this dataset"
-               return report
-          if len(datasets)!=1:
-               raise Exception("Unpexpected number of datasets is returned")
           report['PhEDEx'] = True
-          subscriptions = datasets[0]['subscription']
-          for subscription in subscriptions:
+          for subscription in record['subscription']:
                if report['firstSubscription']==None or report['firstSubscription']>subscription['time_create']:
                     report['firstSubscription'] = subscription['time_create']
                availability = get_availability(subscription['percent_bytes'])
@@ -117,11 +157,21 @@ def get_subscription_information(dataset):
                          report['nAnalysisOpsComplete'] += 1
                elif availability == "incomplete": 
                     report['nIncomplete'] += 1
-               print >>log, form_subscription_report(subscription)
+               report['log'].append(form_subscription_report(subscription))
      except KeyError:
           pass
      return report
 
+def get_dataset_report(dataset, reports):
+     report = reports.get(dataset)
+     if report==None:
+          summary["NotInPhedex"].append(dataset)
+          print >>log, "No information in PhEDEx about this dataset"
+          return new_report()
+     for line in report['log']:
+          print >>log, line
+     return report
+
 def run_command(command):
      # flash stdout to keep order of messages right
      sys.stdout.flush()
@@ -131,72 +181,121 @@ def run_command(command):
 
 # DBS reader
 url = "https://cmsweb.cern.ch/dbs/prod/global/DBSReader"
-api = DbsApi(url=url)
-
-datasets = []
-
-if options.run:
-     datasets = api.listDatasets(run_num=options.run, detail=True)
-if options.era:
-     datasets = api.listDatasets(acquisition_era_name=options.era, detail=True)
-
-nDatasetsToCheck = 0
-for ds in datasets:
-     if datatiers and not ds['data_tier_name'] in datatiers:
-          continue
-     nDatasetsToCheck += 1
-print >>log, "Number of datasets to check: %d" % nDatasetsToCheck
-print "Number of datasets to check: %d" % nDatasetsToCheck
-
-for ds in datasets:
-     if datatiers and not ds['data_tier_name'] in datatiers:
-          continue
+api = dbs_tools.get_api(url)
+
+# Datasets are processed in a pipeline: listing, selection, size lookup,
+# PhEDEx query and classification run concurrently, so the first results
+# are available as soon as the first tier is listed.
+# Datasets matching several runs or eras are checked only once.
+counts = {'listed':0, 'unchanged':0, 'duplicates':0}
+current_status = dict()
+
+def select_datasets(batch):
+     """Apply tier and shard selection. In the incremental mode datasets without
+     problems that didn't change in DBS since the previous check are not
+     queried again"""
+     selected = []
+     for ds in batch:
+          if datatiers and not ds['data_tier_name'] in datatiers:
+               continue
+          if shard and not dbs_tools.in_shard(ds['dataset'], shard):
+               continue
+          counts['listed'] += 1
+          if options.incremental:
+               old = previous_snapshot.get(ds['dataset'])
+               if old and old['status']=='OK' and old['last_modification_date']==ds['last_modification_date'] \
+                       and time.time()-old['checked'] < 86400*options.max_age:
+                    current_status[ds['dataset']] = old['status']
+                    counts['unchanged'] += 1
+                    continue
+          selected.append({'dataset':ds})
+     return selected
+
+thread_data = threading.local()
+def add_size(batch):
+     if not hasattr(thread_data, 'api'):
+          thread_data.api = dbs_tools.make_api(url)
+     for item in batch:
+          item['size'] = dbs_tools.get_dataset_size(thread_data.api, item['dataset']['dataset'])
+     return batch
+
+def add_reports(batch):
+     reports = dict()
+     def add_report(record):
+          reports[record['name']] = get_subscription_information(record)
+     phedex_api.get_subscriptions(phedex, options.phedex_url, [item['dataset']['dataset'] for item in batch],
+                                  add_report, options.phedex_chunk)
+     for item in batch:
+          item['reports'] = reports
+     return batch
+
+pipeline = pipeline_module.Pipeline(dbs_tools.list_datasets(api, dbs_tools.get_queries(runs, eras), datatiers, counts))
+pipeline.add_stage(select_datasets, batch_size=100)
+pipeline.add_stage(add_size, threads=options.dbs_jobs)
+pipeline.add_stage(add_reports, batch_size=options.connections*options.phedex_chunk)
+
+nChecked = 0
+for item in pipeline.run():
+     ds = item['dataset']
      print >>log, "\nDatset:",ds['dataset'],
-     blocks = api.listBlockSummaries(dataset = ds['dataset'])
-     ds_size = blocks[0]['file_size']/pow(2,30)
+     ds_size = item['size']/pow(2,30)
      print >>log, " \t %0.0f GB" % (ds_size)
 
-     report = get_subscription_information(ds['dataset'])
+     report = get_dataset_report(ds['dataset'], item['reports'])
+     status = []
+     if not report['PhEDEx']:
+          status.append("NotInPhedex")
      if options.ignore and report['firstSubscription']!=None and (time.time()-report['firstSubscription'])<86400*options.ignore:
           print >>log, "Skip the dataset availability check since the first subscription is very recent"
-          continue
-     if report['nComplete']==0:
-          summary["NoCompleteCopyAnywhere"].append(ds['dataset'])  
-          if report['nIncomplete']==0:
-               summary["Lost"].append(ds['dataset'])
-     if report['nAnalysisOpsComplete']==0:
-          summary["NoCompleteCopyAnalysisOps"].append(ds['dataset'])  
+          status = ["Skipped"]
+     else:
+          if report['nComplete']==0:
+               summary["NoCompleteCopyAnywhere"].append(ds['dataset'])  
+               status.append("NoCompleteCopyAnywhere")
+               if report['nIncomplete']==0:
+                    summary["Lost"].append(ds['dataset'])
+                    status.append("Lost")
+          if report['nAnalysisOpsComplete']==0:
+               summary["NoCompleteCopyAnalysisOps"].append(ds['dataset'])  
+               status.append("NoCompleteCopyAnalysisOps")
+     current_status[ds['dataset']] = ",".join(status) or "OK"
+     del report['log']
+     record = dict(report)
+     record.update({'dataset':ds['dataset'], 'size':item['size'], 'status':status or ["OK"]})
+     dataset_report.add(record)
+     snapshot.update(ds['dataset'], ds['last_modification_date'], item['size'],
+                     current_status[ds['dataset']], report)
+     nChecked += 1
+     if nChecked % 1000 == 0:
+          snapshot.commit()
+snapshot.commit()
+phedex.close()
+dataset_report.close()
 
-pprint.pprint(summary)
+print >>log, "\nNumber of datasets to check: %d" % counts['listed']
+print "Number of datasets to check: %d" % counts['listed']
+if len(runs) + len(eras) > 1:
+     print >>log, "Number of datasets found for more than one run or era: %d" % counts['duplicates']
+     print "Number of datasets found for more than one run or era: %d" % counts['duplicates']
+if options.incremental:
+     print >>log, "Number of unchanged datasets taken from the previous snapshot: %d" % counts['unchanged']
+     print "Number of unchanged datasets taken from the previous snapshot: %d" % counts['unchanged']
 
-print "Number of valid datasets registered in DBS missing in PhEDEx: %d" % (len(summary["NotInPhedex"]))
-if len(summary["NotInPhedex"])>0:
-     with open("%s-not_in_phedex.txt"%logfile_prefix,'w') as f:
-          for ds in summary["NotInPhedex"]:
-               f.write(ds+"\n")
-
-nMissingData = len(summary["NoCompleteCopyAnywhere"])-len(summary["Lost"])
-print "Number of datasets with missing data (not complete, but above %s%%): %d" % (options.lost_fraction,nMissingData)
-if nMissingData > 0:
-     with open("%s-above_%0.0f-below_100.txt"%(logfile_prefix,options.lost_fraction),'w') as f:
-          for ds in summary["NoCompleteCopyAnywhere"]:
-               if not ds in summary["Lost"]:
-                    f.write(ds+"\n")
-
-print "Number of datasets that are lost (no copy with greater than %s%% availability): %d" % (options.lost_fraction,len(summary["Lost"]))
-if len(summary["Lost"])>0:
-     with open("%s-below_%0.0f.txt"%(logfile_prefix,options.lost_fraction),'w') as f:
-          for ds in summary["Lost"]:
-               f.write(ds+"\n")
-
-nWarning = len(summary["NoCompleteCopyAnalysisOps"])-len(summary["Lost"])
-print "Number of datasets that can disappear (no complete copy subscribed under AnalysisOps): %d" % (nWarning)
-if nWarning>0:
-     with open("%s-warning.txt"%(logfile_prefix),'w') as f:
-          for ds in summary["NoCompleteCopyAnalysisOps"]:
-               if not ds in summary["Lost"]:
-                    f.write(ds+"\n")
+# Status changes since the previous snapshot
+changes = snapshot_store.get_changes(previous_snapshot, current_status)
+snapshot.remove([dataset for dataset, old, new in changes if new == None])
+snapshot.commit()
+if len(previous_snapshot)>0:
+     print "Number of datasets with status change since the previous check: %d" % len(changes)
+     if len(changes)>0:
+          with open("%s-changes.txt"%logfile_prefix,'w') as f:
+               for dataset, old, new in changes:
+                    f.write("%s: %s -> %s\n" % (dataset, old or "new", new or "gone"))
+
+pprint.pprint(summary)
 
+dataset_report_module.print_availability_summary(dataset_report, options.lost_fraction)
+print "Per-dataset report: %s" % dataset_report.path
 
 print "For details see produced files"               
      
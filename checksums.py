@@ -0,0 +1,31 @@
+"""
+Streaming file checksums used by DBS: adler32 and cksum (POSIX CRC-32,
+as printed by the cksum command). The data is read once in large chunks
+and both checksums are updated from the same buffers. zlib computes
+adler32, the CRC is computed by a cksum process fed through a pipe,
+which is much faster than doing it in python.
+"""
+import zlib, subprocess
+
+default_chunk_size = 64*pow(2,20)
+
+def compute(chunks):
+     """Return (adler32 as 8 hex digits, cksum as decimal string) of data
+     given as an iterable of strings"""
+     adler = 1
+     cksum = subprocess.Popen(['cksum'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+     try:
+          for chunk in chunks:
+               adler = zlib.adler32(chunk, adler)
+               cksum.stdin.write(chunk)
+     except:
+          cksum.kill()
+          cksum.wait()
+          raise
+     output = cksum.communicate()[0]
+     if cksum.returncode != 0:
+          raise Exception("cksum failed with exit code %d" % cksum.returncode)
+     return "%08x" % (adler & 0xffffffff), output.split()[0]
+
+def compute_file_checksums(lfn, storage, chunk_size=default_chunk_size):
+     return compute(storage.read_chunks(lfn, chunk_size))
@@ -0,0 +1,80 @@
+"""
+Machine readable per-dataset reports. A record is written as soon as a
+dataset is processed, in JSON Lines format or, if the file name ends
+with .csv, as a CSV row.
+
+Plain text lists of dataset names can be derived from the same stream
+of records. Each list has a file name and a selection function of the
+record's status set, and its file is created only when the first
+dataset is selected.
+"""
+import csv, json
+
+class DatasetReport(object):
+     def __init__(self, path, fields, lists=None):
+          """fields define CSV columns. lists is a dictionary name ->
+          (file name, selection function)"""
+          self.path = path
+          self.fields = fields
+          self.file = open(path, 'w')
+          self.csv = None
+          if path.endswith(".csv"):
+               self.csv = csv.DictWriter(self.file, fields, extrasaction='ignore')
+               self.csv.writeheader()
+          self.lists = lists or dict()
+          self.list_files = dict()
+          self.counts = dict((name, 0) for name in self.lists)
+
+     def add(self, record):
+          """Write a record. record['status'] is a list of status flags"""
+          if self.csv:
+               row = dict(record)
+               for key, value in row.items():
+                    if isinstance(value, (list, set, tuple)):
+                         row[key] = ";".join(value)
+               self.csv.writerow(row)
+          else:
+               self.file.write(json.dumps(record) + "\n")
+          status = set(record['status'])
+          for name, (filename, selected) in self.lists.items():
+               if selected(status):
+                    if name not in self.list_files:
+                         self.list_files[name] = open(filename, 'w')
+                    self.list_files[name].write(record['dataset'] + "\n")
+                    self.counts[name] += 1
+
+     def count(self, name):
+          return self.counts[name]
+
+     def close(self):
+          self.file.close()
+          for f in self.list_files.values():
+               f.close()
+
+def read_records(path):
+     """Records of a report written by DatasetReport"""
+     with open(path) as f:
+          if path.endswith(".csv"):
+               for row in csv.DictReader(f):
+                    row['status'] = row['status'].split(";")
+                    yield row
+          else:
+               for line in f:
+                    yield json.loads(line)
+
+def get_availability_lists(prefix, lost_fraction):
+     """Lists of datasets with problems produced by check_data_availability.py"""
+     return {'not_in_phedex': ("%s-not_in_phedex.txt" % prefix,
+                               lambda status: "NotInPhedex" in status),
+             'missing':       ("%s-above_%0.0f-below_100.txt" % (prefix, lost_fraction),
+                               lambda status: "NoCompleteCopyAnywhere" in status and "Lost" not in status),
+             'lost':          ("%s-below_%0.0f.txt" % (prefix, lost_fraction),
+                               lambda status: "Lost" in status),
+             'warning':       ("%s-warning.txt" % prefix,
+                               lambda status: "NoCompleteCopyAnalysisOps" in status and "Lost" not in status)}
+
+def print_availability_summary(report, lost_fraction):
+     print "Number of valid datasets registered in DBS missing in PhEDEx: %d" % report.count('not_in_phedex')
+     print "Number of datasets with missing data (not complete, but above %s%%): %d" % (lost_fraction, report.count('missing'))
+     print "Number of datasets that are lost (no copy with greater than %s%% availability): %d" % (lost_fraction, report.count('lost'))
+     print "Number of datasets that can disappear (no complete copy subscribed under AnalysisOps): %d" % report.count('warning')
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import sys, os, json, socket
+
+description = """
+Thin front end to dbs3toolsd.py. Usage:
+
+     dbs3tools.py publish|check|inject [tool options]
+
+The job is executed by the resident service and its output is shown
+here. If the service is not running, the tool is executed directly.
+Set DBS3TOOLS_SOCKET to use a non default socket.
+"""
+
+tools = {'publish': 'publish_dataset.py',
+         'check':   'check_data_availability.py',
+         'inject':  'inject_data_in_DDM.py'}
+
+socket_path = os.environ.get('DBS3TOOLS_SOCKET',
+                             os.path.join(os.path.expanduser("~"), ".dbs3tools", "daemon.sock"))
+
+if len(sys.argv)<2 or sys.argv[1] not in tools:
+     print description
+     sys.exit(1)
+
+tool = sys.argv[1]
+args = sys.argv[2:]
+
+conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+     conn.connect(socket_path)
+except socket.error:
+     # no service, run the tool in this process
+     script = os.path.join(os.path.dirname(os.path.abspath(__file__)), tools[tool])
+     os.execv(sys.executable, [sys.executable, script] + args)
+
+request = {'tool':tool, 'args':args, 'cwd':os.getcwd(), 'env':dict(os.environ)}
+conn.sendall(json.dumps(request) + "\n")
+
+# Output is passed through as it arrives. The exit code comes last
+# after a NUL character.
+tail = ""
+while True:
+     data = conn.recv(65536)
+     if not data: break
+     data = tail + data
+     marker = data.rfind("\0")
+     if marker >= 0:
+          sys.stdout.write(data[:marker])
+          tail = data[marker:]
+     else:
+          # keep a possible beginning of the exit code line
+          sys.stdout.write(data)
+          tail = ""
+     sys.stdout.flush()
+conn.close()
+
+if tail.startswith("\0") and tail[1:].strip().isdigit():
+     sys.exit(int(tail[1:].strip()))
+sys.stdout.write(tail)
+print "ERROR: the job was terminated without reporting its exit code"
+sys.exit(1)
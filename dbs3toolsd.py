@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+import sys, os, time, json, socket, errno, runpy, traceback
+from optparse import OptionParser
+import instrumentation
+
+description = """
+Resident service running publish, check and inject jobs. Heavy modules
+(ROOT, DBS client, pycurl) are imported and DBS clients are created once
+at startup. Each job is executed in a forked copy of the service, so it
+starts with everything already initialized. Jobs are submitted with
+dbs3tools.py over a local Unix socket.
+"""
+
+default_socket = os.path.join(os.path.expanduser("~"), ".dbs3tools", "daemon.sock")
+
+tools = {'publish': 'publish_dataset.py',
+         'check':   'check_data_availability.py',
+         'inject':  'inject_data_in_DDM.py'}
+
+# requests are read by the accept loop, so a client that doesn't send
+# its request in time must not block other clients
+request_timeout = 5.0
+
+# DBS instances used by the tools
+dbs_urls = ["https://cmsweb.cern.ch/dbs/prod/global/DBSReader",
+            "https://cmsweb.cern.ch/dbs/prod/phys03/DBSReader/",
+            "https://cmsweb.cern.ch/dbs/prod/phys03/DBSWriter/"]
+
+def warm_up():
+     """Import everything the tools need and create DBS clients"""
+     argv = sys.argv
+     sys.argv = [] # clear up list of arguments to avoid confusing ROOT
+     import file_probe
+     sys.argv = argv
+     import pycurl, dbs_tools, http_client, phedex, storage, metadata_cache, publication_journal
+     for url in dbs_urls:
+          dbs_tools.get_api(url)
+
+def read_request(conn, timeout):
+     """Read one JSON line. socket.timeout is raised if the whole request
+     doesn't arrive within timeout seconds."""
+     deadline = time.time() + timeout
+     data = ""
+     while not data.endswith("\n"):
+          remaining = deadline - time.time()
+          if remaining <= 0:
+               raise socket.timeout("request not received in time")
+          conn.settimeout(remaining)
+          chunk = conn.recv(65536)
+          if not chunk: break
+          data += chunk
+     return json.loads(data)
+
+def run_job(conn, request):
+     """Executed in a forked process. Output of the tool, including its
+     subprocesses, goes directly to the client. The last line sent is the
+     exit code prefixed with a NUL character."""
+     exit_code = 0
+     try:
+          tool = request['tool']
+          if tool not in tools:
+               raise Exception("Unknown tool %s. Available: %s" % (tool, ", ".join(sorted(tools))))
+          script = os.path.join(os.path.dirname(os.path.abspath(__file__)), tools[tool])
+          os.chdir(request['cwd'])
+          os.environ.clear()
+          for key, value in request['env'].items():
+               os.environ[key.encode('utf-8')] = value.encode('utf-8')
+          sys.stdout.flush()
+          sys.stderr.flush()
+          os.dup2(conn.fileno(), 1)
+          os.dup2(conn.fileno(), 2)
+          sys.argv = [script] + [arg.encode('utf-8') for arg in request['args']]
+          # measurements of the warm up don't belong to the job
+          instrumentation.metrics.take()
+          runpy.run_path(script, run_name="__main__")
+     except SystemExit, e:
+          if e.code == None:
+               exit_code = 0
+          elif isinstance(e.code, int):
+               exit_code = e.code
+          else:
+               print >>sys.stderr, e.code
+               exit_code = 1
+     except:
+          traceback.print_exc()
+          exit_code = 1
+     try:
+          # os._exit skips atexit handlers
+          instrumentation.finish()
+     except:
+          traceback.print_exc()
+     try:
+          sys.stdout.flush()
+          sys.stderr.flush()
+          conn.sendall("\0%d\n" % exit_code)
+     finally:
+          os._exit(exit_code)
+
+def reap_children(jobs):
+     while len(jobs)>0:
+          try:
+               pid, status = os.waitpid(-1, os.WNOHANG)
+          except OSError, e:
+               if e.errno == errno.ECHILD: jobs.clear()
+               break
+          if pid == 0: break
+          jobs.discard(pid)
+
+def serve(path, max_jobs):
+     directory = os.path.dirname(path)
+     if directory and not os.path.exists(directory):
+          os.makedirs(directory)
+     if os.path.exists(path):
+          os.remove(path)
+     server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+     old_umask = os.umask(0077)
+     server.bind(path)
+     os.umask(old_umask)
+     server.listen(16)
+     server.settimeout(1.0)
+     print "Listening on %s" % path
+     sys.stdout.flush()
+     jobs = set()
+     try:
+          while True:
+               reap_children(jobs)
+               try:
+                    conn, address = server.accept()
+               except socket.timeout:
+                    continue
+               except socket.error, e:
+                    if e.errno == errno.EINTR: continue
+                    raise
+               try:
+                    request = read_request(conn, request_timeout)
+               except socket.error:
+                    # timeout or client gone
+                    conn.close()
+                    continue
+               except ValueError:
+                    try:
+                         conn.sendall("Malformed request\n\0%d\n" % 1)
+                    except socket.error:
+                         pass
+                    conn.close()
+                    continue
+               # the job writes its output to the connection in blocking mode
+               conn.settimeout(None)
+               while len(jobs) >= max_jobs:
+                    pid, status = os.waitpid(-1, 0)
+                    jobs.discard(pid)
+               pid = os.fork()
+               if pid == 0:
+                    server.close()
+                    run_job(conn, request)
+               jobs.add(pid)
+               conn.close()
+     finally:
+          server.close()
+          if os.path.exists(path):
+               os.remove(path)
+
+if __name__ == "__main__":
+     parser = OptionParser(usage = "\n\t%prog [options]", description = description, epilog= ' ')
+     parser.add_option("-s", "--socket", dest="socket", metavar="PATH", default=default_socket,
+                       help="Unix socket to listen on. Default: %default")
+     parser.add_option("-j", "--max-jobs", dest="max_jobs", metavar="N", type="int", default=8,
+                       help="Maximum number of jobs running at the same time. Default: %default")
+     (options, args) = parser.parse_args()
+     sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+     warm_up()
+     serve(options.socket, options.max_jobs)
@@ -0,0 +1,140 @@
+"""
+Helpers for bulk DBS queries
+"""
+import threading, hashlib
+from multiprocessing.pool import ThreadPool
+import instrumentation, governor
+
+# DbsApi clients by url. A resident process (dbs3toolsd.py) creates them
+# once and all jobs it runs reuse them.
+apis = dict()
+
+def make_api(url):
+     """New DbsApi client with timing of all calls. Calls are limited by
+     the governor of the DBS instance."""
+     from dbs.apis.dbsClient import DbsApi
+     return governor.GovernedApi(instrumentation.InstrumentedApi(DbsApi(url=url), "dbs"), governor.get(url))
+
+def get_api(url):
+     if url not in apis:
+          apis[url] = make_api(url)
+     return apis[url]
+
+def chunks(items, size):
+     """Split a list into consecutive pieces of at most size elements"""
+     for i in range(0, len(items), size):
+          yield items[i:i+size]
+
+def split_list(text):
+     """Comma separated list without empty and repeated elements"""
+     items = []
+     for item in (text or "").split(','):
+          item = item.strip()
+          if item and item not in items:
+               items.append(item)
+     return items
+
+def get_queries(runs, eras):
+     """listDatasets arguments for each run and era"""
+     return [{'run_num':run} for run in runs] + [{'acquisition_era_name':era} for era in eras]
+
+def get_period_name(runs, eras):
+     """Short name of a set of runs and eras used in file names"""
+     periods = runs + eras
+     if len(periods) > 3:
+          return "%s-%s-%d_periods" % (periods[0], periods[-1], len(periods))
+     return "_".join(periods)
+
+def parse_shard(text):
+     """Parse shard specification i/N with 0 <= i < N"""
+     try:
+          index, count = [int(x) for x in text.split('/')]
+     except ValueError:
+          raise ValueError("Invalid shard %s. Expected format is i/N" % text)
+     if count < 1 or index < 0 or index >= count:
+          raise ValueError("Invalid shard %s. Shard index must be between 0 and N-1" % text)
+     return index, count
+
+def in_shard(dataset, shard):
+     """Deterministic assignment of datasets to shards. The same dataset
+     gets the same shard on every host and in every run."""
+     index, count = shard
+     return int(hashlib.md5(dataset).hexdigest()[:8], 16) % count == index
+
+def list_datasets(api, queries, tiers=None, counts=None):
+     """Yield datasets matching any of the listDatasets queries. Each
+     dataset is returned once even if it matches several queries. If
+     tiers are given, each query is done per tier, so that the first
+     datasets are available before everything is listed. Number of
+     duplicates is counted in counts['duplicates'] if counts is given."""
+     seen = set()
+     for query in queries:
+          for tier in (tiers or [None]):
+               kwargs = dict(query)
+               if tier: kwargs['data_tier_name'] = tier
+               for ds in api.listDatasets(detail=True, **kwargs):
+                    if ds['dataset'] in seen:
+                         if counts != None:
+                              counts['duplicates'] = counts.get('duplicates', 0) + 1
+                         continue
+                    seen.add(ds['dataset'])
+                    yield ds
+
+def find_known_files(api, lfns, chunk_size=200):
+     """Look up which files are already registered in DBS. LFNs are
+     sent in chunks of chunk_size per request. Returns a dictionary
+     lfn -> set of dataset names for known files only."""
+     known = dict()
+     for lfn_chunk in chunks(lfns, chunk_size):
+          for f in api.listFileArray(logical_file_name=lfn_chunk, detail=True):
+               known.setdefault(f['logical_file_name'], set()).add(f['dataset'])
+     return known
+
+def split_in_blocks(files, max_files, max_size):
+     """Group DBS file meta data into blocks limited by number of files and
+     total size. Blocks are yielded as soon as they are complete."""
+     block = []
+     block_size = 0
+     for file in files:
+          if len(block)>0 and block_size + file['file_size'] > max_size:
+               yield block
+               block = []
+               block_size = 0
+          block.append(file)
+          block_size += file['file_size']
+          if len(block) >= max_files:
+               yield block
+               block = []
+               block_size = 0
+     if len(block)>0:
+          yield block
+
+def get_dataset_size(api, dataset):
+     """Total size of dataset files in bytes"""
+     blocks = api.listBlockSummaries(dataset = dataset)
+     if len(blocks)==0 or blocks[0]['file_size']==None:
+          return 0
+     return blocks[0]['file_size']
+
+class DatasetSizes(object):
+     """Total size in bytes of datasets using up to jobs concurrent
+     listBlockSummaries requests. DbsApi objects are not thread safe, so
+     each thread gets its own one from make_api(). The threads and their
+     clients are reused by all calls of get() until close()."""
+     def __init__(self, make_api, jobs=10):
+          self.make_api = make_api
+          self.local = threading.local()
+          self.pool = ThreadPool(jobs)
+
+     def _get_size(self, dataset):
+          if not hasattr(self.local, 'api'):
+               self.local.api = self.make_api()
+          return get_dataset_size(self.local.api, dataset)
+
+     def get(self, datasets):
+          """Returns dictionary dataset -> size"""
+          return dict(zip(datasets, self.pool.map(self._get_size, datasets, 1)))
+
+     def close(self):
+          self.pool.close()
+          self.pool.join()
@@ -0,0 +1,160 @@
+"""
+Extraction of DBS meta data from EDM files. Each file is opened only
+once and all information needed for publication (number of events,
+file size and run/lumi pairs) is taken from the same file handle.
+"""
+import array, time, collections
+import ROOT
+import instrumentation
+ROOT.gROOT.SetBatch(True)
+
+try:
+     import numpy
+except ImportError:
+     # buffers are copied with the array module
+     numpy = None
+
+FileInfo = collections.namedtuple('FileInfo', ['lfn', 'event_count', 'file_size', 'lumis', 'adler32', 'check_sum'])
+FileInfo.__new__.__defaults__ = (None, None) # checksums are optional
+
+class LumiList(object):
+     """Run and lumi section numbers stored as two parallel arrays"""
+     def __init__(self, runs=None, lumis=None):
+          self.runs = runs if runs != None else array.array('L')
+          self.lumis = lumis if lumis != None else array.array('L')
+          if len(self.runs) != len(self.lumis):
+               raise Exception("Inconsistent number of runs and lumis")
+     def __len__(self):
+          return len(self.runs)
+     def __iter__(self):
+          return iter(zip(self.runs, self.lumis))
+     def __eq__(self, other):
+          return self.runs == other.runs and self.lumis == other.lumis
+     def __ne__(self, other):
+          return not self.__eq__(other)
+     def append(self, run, lumi):
+          self.runs.append(run)
+          self.lumis.append(lumi)
+
+class LumiRanges(object):
+     """Compact form of a lumi list: ranges of consecutive lumi sections of
+     the same run stored as three parallel arrays. A file usually has one
+     or a few ranges, however many lumi sections it contains."""
+     def __init__(self, runs=None, firsts=None, lasts=None):
+          self.runs = runs if runs != None else array.array('L')
+          self.firsts = firsts if firsts != None else array.array('L')
+          self.lasts = lasts if lasts != None else array.array('L')
+
+     @classmethod
+     def from_lumis(cls, lumis):
+          """Compress (run, lumi) pairs. Repeated pairs are dropped."""
+          ranges = cls()
+          for run, lumi in sorted(set(lumis)):
+               if len(ranges.runs)>0 and ranges.runs[-1] == run and ranges.lasts[-1]+1 == lumi:
+                    ranges.lasts[-1] = lumi
+               else:
+                    ranges.add_range(run, lumi, lumi)
+          return ranges
+
+     @classmethod
+     def from_ranges(cls, ranges):
+          compact = cls()
+          for run, first, last in ranges:
+               compact.add_range(run, first, last)
+          return compact
+
+     def add_range(self, run, first, last):
+          self.runs.append(run)
+          self.firsts.append(first)
+          self.lasts.append(last)
+
+     def ranges(self):
+          """List of [run, first lumi, last lumi]"""
+          return [[run, first, last] for run, first, last in zip(self.runs, self.firsts, self.lasts)]
+
+     def __len__(self):
+          """Number of lumi sections"""
+          return sum(self.lasts) - sum(self.firsts) + len(self.runs)
+
+     def __iter__(self):
+          """Expand into (run, lumi) pairs"""
+          for run, first, last in zip(self.runs, self.firsts, self.lasts):
+               for lumi in xrange(first, last+1):
+                    yield run, lumi
+
+def get_run_lumi_list_loop(tree):
+     """Read lumis entry by entry. Slow, kept as a reference and fallback"""
+     lumis = LumiList()
+     for entry in tree:
+          lumis.append(entry.LuminosityBlockAuxiliary.run(),
+                       entry.LuminosityBlockAuxiliary.luminosityBlock())
+     return lumis
+
+def buffer_to_array(values, n):
+     """Convert the first n doubles of a TTree::Draw buffer into an array
+     of integers without accessing entries one by one through PyROOT"""
+     result = array.array('L')
+     if numpy:
+          doubles = numpy.frombuffer(values, dtype='float64', count=n)
+          result.fromstring(doubles.astype('u%d' % result.itemsize).tostring())
+     else:
+          doubles = array.array('d')
+          doubles.fromstring(buffer(values, 0, n*doubles.itemsize))
+          result.extend(map(int, doubles))
+     return result
+
+def get_run_lumi_list(tree):
+     """Read run and lumi columns in one pass using TTree::Draw without
+     going through python objects for each entry"""
+     n = tree.GetEntries()
+     if n == 0: return LumiList()
+     tree.SetEstimate(n+1)
+     selected = tree.Draw("LuminosityBlockAuxiliary.id_.run_:LuminosityBlockAuxiliary.id_.luminosityBlock_", "", "goff")
+     if selected != n:
+          return get_run_lumi_list_loop(tree)
+     runs = tree.GetV1()
+     lumis = tree.GetV2()
+     runs.SetSize(n)
+     lumis.SetSize(n)
+     try:
+          return LumiList(buffer_to_array(runs, n), buffer_to_array(lumis, n))
+     except (TypeError, ValueError):
+          # buffer doesn't expose its memory
+          return LumiList(array.array('L', [int(x) for x in runs]),
+                          array.array('L', [int(x) for x in lumis]))
+
+def timed_open(url):
+     start = time.time()
+     f = ROOT.TFile.Open(url)
+     instrumentation.metrics.record("root.open", time.time()-start, error=(not f or f.IsZombie()))
+     return f
+
+def open_file(lfn, storage):
+     """Open file with ROOT. If the site resolved by the storage fails,
+     the file is opened again through the redirector."""
+     url = storage.url(lfn)
+     f = timed_open(url)
+     if (not f or f.IsZombie()) and storage.failed(lfn):
+          url = storage.url(lfn)
+          f = timed_open(url)
+     if not f or f.IsZombie(): raise Exception("Failed to open file %s" % url)
+     return f, url
+
+def probe_file(lfn, storage):
+     """Open the file once and return FileInfo"""
+     f, url = open_file(lfn, storage)
+     try:
+          with instrumentation.timed("root.read") as call:
+               events = f.Get("Events")
+               if not events: raise Exception("No Events tree in file %s" % url)
+               lumi_tree = f.Get("LuminosityBlocks")
+               if not lumi_tree: raise Exception("No LuminosityBlocks tree in file %s" % url)
+               info = FileInfo(lfn, events.GetEntries(), f.GetSize(), get_run_lumi_list(lumi_tree))
+               call['bytes'] = f.GetBytesRead()
+          return info
+     finally:
+          f.Close()
+
+def get_dbs_lumi_list(lumis):
+     """Convert (run, lumi) pairs into DBS file_lumi_list format"""
+     return [{'lumi_section_num':int(lumi), 'run_num':int(run)} for run, lumi in lumis]
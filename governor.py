@@ -0,0 +1,204 @@
+"""
+Adaptive limits of requests to cmsweb services. Each endpoint (a DBS
+instance, the PhEDEx data service) has one governor shared by all
+threads of a process. A governor
+
+  - spaces requests evenly to stay below a requests per second ceiling,
+  - limits the number of requests in flight. The limit grows by one per
+    round trip of successful requests and is halved when the service
+    answers with 429/503 or a response is slower than the target
+    latency (AIMD). A burst of such responses counts as one event.
+
+Throttled requests are retried with exponential backoff. DBS calls
+that write data (insert*, update*) are not idempotent and are never
+resent. They are expected to be slow, so their latency doesn't lower
+the limit either. The state of all governors is printed at the end of
+a run and included in exported metrics.
+"""
+import sys, time, random, threading
+import instrumentation
+
+throttle_codes = (429, 503)
+
+# prefixes of DBS methods that change data
+write_prefixes = ('insert', 'update')
+
+# used for governors created after setup()
+defaults = {'max_concurrency':50, 'rate':50.0, 'target_latency':10.0, 'retries':3, 'backoff':5.0}
+
+governors = dict()
+governors_lock = threading.Lock()
+
+class Governor(object):
+     def __init__(self, name, max_concurrency, rate, target_latency):
+          self.name = name
+          self.configure(max_concurrency, rate, target_latency)
+          self.in_flight = 0
+          self.next_start = 0
+          self.last_decrease = 0
+          self.condition = threading.Condition()
+          self.counts = {'requests':0, 'throttled':0, 'slow':0, 'decreases':0}
+          self.lowest_limit = self.limit
+
+     def configure(self, max_concurrency, rate, target_latency):
+          # a limit below one request would block all requests forever
+          self.max_concurrency = max(1, max_concurrency)
+          self.rate = rate
+          self.target_latency = target_latency
+          self.interval = 1.0/rate if rate > 0 else 0
+          self.limit = float(self.max_concurrency)
+
+     def _start(self, now):
+          start = max(now, self.next_start)
+          self.next_start = start + self.interval
+          self.in_flight += 1
+          self.counts['requests'] += 1
+          return start
+
+     def acquire(self):
+          """Wait for a free slot and the next allowed start time"""
+          with self.condition:
+               while self.in_flight >= int(self.limit):
+                    # wait with timeout to stay responsive to Ctrl-C
+                    self.condition.wait(1)
+               start = self._start(time.time())
+          delay = start - time.time()
+          if delay > 0:
+               time.sleep(delay)
+
+     def try_acquire(self):
+          """Take a slot if a request can start right now"""
+          with self.condition:
+               now = time.time()
+               if self.in_flight >= int(self.limit) or now < self.next_start:
+                    return False
+               self._start(now)
+               return True
+
+     def wait_time(self):
+          """Time until try_acquire may succeed"""
+          with self.condition:
+               return min(max(self.next_start - time.time(), 0.01), 1)
+
+     def release(self, latency, throttled=False, check_latency=True):
+          """check_latency is False for requests that are slow by nature"""
+          with self.condition:
+               self.in_flight -= 1
+               now = time.time()
+               slow = check_latency and self.target_latency and latency > self.target_latency
+               if throttled or slow:
+                    self.counts['throttled' if throttled else 'slow'] += 1
+                    if now - self.last_decrease > latency:
+                         self.limit = max(1.0, self.limit/2)
+                         self.lowest_limit = min(self.lowest_limit, self.limit)
+                         self.last_decrease = now
+                         self.counts['decreases'] += 1
+               else:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1/self.limit)
+               self.condition.notify_all()
+
+     def state(self):
+          with self.condition:
+               state = dict(self.counts)
+               state.update({'limit':self.limit, 'lowest_limit':self.lowest_limit,
+                             'max_concurrency':self.max_concurrency, 'rate':self.rate or 0})
+               return state
+
+def get(endpoint):
+     """Governor of an endpoint, e.g. a service url"""
+     with governors_lock:
+          if endpoint not in governors:
+               governors[endpoint] = Governor(endpoint, defaults['max_concurrency'], defaults['rate'],
+                                              defaults['target_latency'])
+          return governors[endpoint]
+
+def is_throttled(exception):
+     return getattr(exception, 'code', None) in throttle_codes
+
+def backoff(attempt):
+     time.sleep(defaults['backoff'] * pow(2, attempt) * random.uniform(0.5, 1.5))
+
+def _call(governor, function, args, kwargs, retries, check_latency):
+     attempt = 0
+     while True:
+          governor.acquire()
+          start = time.time()
+          try:
+               result = function(*args, **kwargs)
+          except Exception, e:
+               throttled = is_throttled(e)
+               governor.release(time.time()-start, throttled, check_latency)
+               if not throttled or attempt >= retries:
+                    raise
+               backoff(attempt)
+               attempt += 1
+               continue
+          governor.release(time.time()-start, check_latency=check_latency)
+          return result
+
+def call(governor, function, *args, **kwargs):
+     """Call function within the limits of governor. Throttled calls are retried."""
+     return _call(governor, function, args, kwargs, defaults['retries'], True)
+
+def call_once(governor, function, *args, **kwargs):
+     """Call a function that changes data within the limits of governor. A
+     throttled call may have been completed by the service already, so it
+     isn't retried. Its latency isn't compared with the target."""
+     return _call(governor, function, args, kwargs, 0, False)
+
+class GovernedApi(object):
+     """Wrapper making every public method call of an API object through a
+     governor. Methods that write data are called with call_once."""
+     def __init__(self, api, governor):
+          self._api = api
+          self._governor = governor
+
+     def __getattr__(self, name):
+          attr = getattr(self._api, name)
+          if name.startswith('_') or not callable(attr):
+               return attr
+          governed = call_once if name.startswith(write_prefixes) else call
+          def governed_call(*args, **kwargs):
+               return governed(self._governor, attr, *args, **kwargs)
+          return governed_call
+
+def get_states():
+     with governors_lock:
+          return dict((name, governor.state()) for name, governor in governors.items())
+
+def print_summary():
+     states = get_states()
+     if len(states)==0: return
+     print "Request governors:"
+     for name, state in sorted(states.items()):
+          rate = "%g/s" % state['rate'] if state['rate'] else "none"
+          print "\t%s: %d requests, %d throttled, %d slow, concurrency limit %0.1f (lowest %0.1f, max %d), rate limit %s" % (
+               name, state['requests'], state['throttled'], state['slow'], state['limit'],
+               state['lowest_limit'], state['max_concurrency'], rate)
+     sys.stdout.flush()
+
+def add_options(parser):
+     parser.add_option("--rate-limit", dest="rate_limit", metavar="N", type="float", default=defaults['rate'],
+                       help="Maximum number of requests per second to each DBS or PhEDEx endpoint. 0 means no limit. Default: %default")
+     parser.add_option("--max-concurrency", dest="max_concurrency", metavar="N", type="int", default=defaults['max_concurrency'],
+                       help="Maximum number of requests in flight to each endpoint. The actual limit is lowered automatically when the service is slow or throttles requests. Default: %default")
+     parser.add_option("--target-latency", dest="target_latency", metavar="SECONDS", type="float", default=defaults['target_latency'],
+                       help="Slower responses reduce the number of requests in flight. 0 disables it. Default: %default")
+     parser.add_option("--throttle-retries", dest="throttle_retries", metavar="N", type="int", default=defaults['retries'],
+                       help="Number of retries of requests rejected with HTTP 429 or 503. Default: %default")
+
+def setup(options):
+     if options.max_concurrency < 1:
+          print "ERROR: --max-concurrency must be at least 1"
+          sys.exit(1)
+     if options.rate_limit < 0:
+          print "ERROR: --rate-limit must not be negative"
+          sys.exit(1)
+     defaults.update({'rate':options.rate_limit, 'max_concurrency':options.max_concurrency,
+                      'target_latency':options.target_latency, 'retries':options.throttle_retries})
+     # governors may already exist in a resident process (dbs3toolsd.py)
+     with governors_lock:
+          for governor in governors.values():
+               governor.configure(defaults['max_concurrency'], defaults['rate'], defaults['target_latency'])
+     instrumentation.sections['governors'] = get_states
+     instrumentation.exit_handlers.append((print_summary, ()))
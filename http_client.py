@@ -0,0 +1,181 @@
+"""
+HTTPS client for cmsweb services with grid proxy authentication.
+
+Curl handles are kept open and reused, so that connections stay alive
+and the TLS handshake is done only once per connection instead of once
+per request. Several requests can be performed concurrently using a
+CurlMulti pool of persistent handles.
+"""
+import re, time, pycurl
+from StringIO import StringIO
+import instrumentation, governor as governor_module
+
+class HttpError(Exception):
+     def __init__(self, url, code, message=""):
+          Exception.__init__(self, "HTTP request %s failed with code %s %s" % (url, code, message))
+          self.url = url
+          self.code = code
+
+class HttpClient(object):
+     def __init__(self, cert, capath="/etc/grid-security/certificates", cainfo=None, max_connections=10, timeout=300, operation="http", governor=None):
+          if max_connections < 1:
+               raise ValueError("max_connections must be at least 1")
+          self.cert = cert
+          self.capath = capath
+          self.cainfo = cainfo or cert
+          self.max_connections = max_connections
+          self.timeout = timeout
+          self.handles = []   # idle persistent handles
+          self.multi = None   # keeps connection cache of concurrent requests
+          self.operation = operation  # name used in metrics
+          self.governor = governor    # limits request rate and concurrency
+
+     def _get_handle(self):
+          if len(self.handles)>0:
+               return self.handles.pop()
+          curl = pycurl.Curl()
+          curl.setopt(pycurl.SSL_VERIFYPEER, 1)
+          curl.setopt(pycurl.SSL_VERIFYHOST, 2)
+          curl.setopt(pycurl.CAINFO, self.cainfo)
+          curl.setopt(pycurl.CAPATH, self.capath)
+          curl.setopt(pycurl.SSLKEY, self.cert)
+          curl.setopt(pycurl.SSLCERT, self.cert)
+          curl.setopt(pycurl.TIMEOUT, self.timeout)
+          curl.setopt(pycurl.NOSIGNAL, 1)
+          if hasattr(pycurl, 'TCP_KEEPALIVE'):
+               curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+          return curl
+
+     def _release_handle(self, curl):
+          if len(self.handles) < self.max_connections:
+               self.handles.append(curl)
+          else:
+               curl.close()
+
+     def _prepare(self, curl, url, write, header=None):
+          curl.setopt(pycurl.URL, str(url))
+          curl.setopt(pycurl.WRITEFUNCTION, write)
+          curl.setopt(pycurl.HEADERFUNCTION, header or (lambda line: None))
+
+     def _prepare_success_writer(self, curl, url, write):
+          """Pass only bodies of 2xx responses to write. Error pages, e.g.
+          of throttled requests, are dropped. The error itself is reported
+          by _check. The status is taken from the status line, since
+          getinfo() can't be used during a transfer."""
+          status = [None]
+          def header(line):
+               match = re.match(r'HTTP/\S+\s+(\d+)', line)
+               if match:
+                    status[0] = int(match.group(1))
+          def write_success(data):
+               if status[0] != None and 200 <= status[0] < 300:
+                    return write(data)
+          self._prepare(curl, url, write_success, header)
+
+     def _check(self, curl, url):
+          code = curl.getinfo(pycurl.RESPONSE_CODE)
+          if code >= 400:
+               raise HttpError(url, code)
+
+     def _record(self, curl, error=False):
+          latency = curl.getinfo(pycurl.TOTAL_TIME)
+          instrumentation.metrics.record(self.operation, latency, int(curl.getinfo(pycurl.SIZE_DOWNLOAD)), error)
+          if self.governor:
+               self.governor.release(latency, curl.getinfo(pycurl.RESPONSE_CODE) in governor_module.throttle_codes)
+
+     def get(self, url, write=None):
+          """Perform a request. The response is returned as a string or,
+          if write function is given, passed to it chunk by chunk."""
+          storage = None
+          if not write:
+               storage = StringIO()
+               write = storage.write
+          curl = self._get_handle()
+          if self.governor:
+               self.governor.acquire()
+          try:
+               if storage:
+                    self._prepare(curl, url, write)
+               else:
+                    self._prepare_success_writer(curl, url, write)
+               curl.perform()
+               self._check(curl, url)
+          except:
+               self._record(curl, True)
+               # the connection state is unknown after a failure
+               curl.close()
+               raise
+          self._record(curl)
+          self._release_handle(curl)
+          if storage:
+               return storage.getvalue()
+
+     def get_many(self, urls, writers=None):
+          """Perform requests concurrently using at most max_connections
+          connections. Returns a list of responses in the order of urls.
+          Failed requests are represented by exception objects. If a list
+          of write functions is given, each successful response is passed
+          to its writer chunk by chunk and None is returned for it instead."""
+          results = [None] * len(urls)
+          if not self.multi:
+               self.multi = pycurl.CurlMulti()
+          multi = self.multi
+          pending = list(enumerate(urls))
+          pending.reverse()
+          active = dict()
+          while len(pending)>0 or len(active)>0:
+               while len(pending)>0 and len(active) < self.max_connections:
+                    if self.governor and not self.governor.try_acquire():
+                         break
+                    index, url = pending.pop()
+                    curl = self._get_handle()
+                    storage = None
+                    if writers:
+                         self._prepare_success_writer(curl, url, writers[index])
+                    else:
+                         storage = StringIO()
+                         self._prepare(curl, url, storage.write)
+                    active[curl] = (index, url, storage)
+                    multi.add_handle(curl)
+               while True:
+                    status, nActive = multi.perform()
+                    if status != pycurl.E_CALL_MULTI_PERFORM: break
+               while True:
+                    nQueued, succeeded, failed = multi.info_read()
+                    for curl in succeeded:
+                         multi.remove_handle(curl)
+                         index, url, storage = active.pop(curl)
+                         try:
+                              self._check(curl, url)
+                              self._record(curl)
+                              if storage:
+                                   results[index] = storage.getvalue()
+                         except HttpError, e:
+                              self._record(curl, True)
+                              results[index] = e
+                         self._release_handle(curl)
+                    for curl, errno, message in failed:
+                         multi.remove_handle(curl)
+                         index, url, storage = active.pop(curl)
+                         results[index] = HttpError(url, errno, message)
+                         self._record(curl, True)
+                         curl.close()
+                    if nQueued == 0: break
+               if len(active)>0:
+                    timeout = 1.0
+                    if len(pending)>0 and self.governor:
+                         # wake up when the governor lets the next request start
+                         timeout = self.governor.wait_time()
+                    multi.select(timeout)
+               elif len(pending)>0 and self.governor:
+                    # nothing in flight, the governor holds back the next request
+                    time.sleep(self.governor.wait_time())
+          return results
+
+     def close(self):
+          for curl in self.handles:
+               curl.close()
+          self.handles = []
+          if self.multi:
+               self.multi.close()
+               self.multi = None
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
-import  sys, time, json, urllib2, subprocess, pprint, re, pycurl
+import  sys, time, json, urllib2, subprocess, pprint, re
 from dbs.apis.dbsClient import DbsApi
+import http_client, dbs_tools, instrumentation, governor, injection_scheduler, phedex as phedex_api
+import dataset_report as dataset_report_module
 
 from optparse import OptionParser
-from StringIO import StringIO    
 from ast import literal_eval
 
 description = """
@@ -16,12 +17,12 @@ in DBS, i.e. it's the total dataset size, not only the input run.
 parser = OptionParser(usage = "\n\t%prog [options]", description = description, epilog= ' ')
 parser.add_option("-t", "--tier", dest="tiers", metavar="LIST", default = "AOD,MINIAOD",
                   help="comma separated list of data tiers without whitespaces. Default: %default")
-parser.add_option("-r", "--run", dest="run", metavar="NUMBER",
-                  help="run number")
+parser.add_option("-r", "--run", dest="run", metavar="LIST",
+                  help="comma separated list of run numbers")
 parser.add_option("-s", "--size", dest="size", metavar="NUMBER",
                   help="Projected size. For open datasets use 10000 as a starting value unless you have a better estimate. If nothing is given current size is used.")
 parser.add_option("-e", "--era", dest="era", metavar="TEXT",
-                  help="Look for all datasets corresponding to a given production Era. Example: 'Run2015C'")
+                  help="Look for all datasets corresponding to given production Eras (comma separated list). Example: 'Run2015C,Run2015D'. Datasets matching any of the runs and eras are checked once.")
 parser.add_option("-i", "--injector", dest="injector", metavar="PATH",
                   default = './assignDatasetToSite.py',
                   help="full path to assignDatasetToSite.py script. Default: %default")
@@ -37,10 +38,57 @@ parser.add_option("--check", dest="check", action="store_true", default=False,
 parser.add_option("--log", dest="log", action="store_true", default=False,
                   help="Write a log file. File name will be: [era/run number]-[tiers]-[processing type]-[timestamp].log")
 
+parser.add_option("--proxy", dest="proxy", metavar="FILE",
+                  default = "/tmp/x509up_u11792",
+                  help="Grid proxy used to access PhEDEx. Default: %default")
+parser.add_option("--phedex-url", dest="phedex_url", metavar="URL",
+                  default = phedex_api.default_url,
+                  help="PhEDEx data service. Default: %default")
+parser.add_option("--connections", dest="connections", metavar="NUMBER", type="int",
+                  default = 10,
+                  help="Maximum number of concurrent PhEDEx requests. Default: %default")
+parser.add_option("--phedex-chunk", dest="phedex_chunk", metavar="NUMBER", type="int",
+                  default = 25,
+                  help="Number of datasets per PhEDEx request. Default: %default")
+parser.add_option("--dbs-jobs", dest="dbs_jobs", metavar="NUMBER", type="int",
+                  default = 10,
+                  help="Number of concurrent DBS requests for dataset sizes. Default: %default")
+parser.add_option("-j", "--jobs", dest="jobs", metavar="NUMBER", type="int",
+                  default = 4,
+                  help="Number of injector processes running at the same time. Default: %default")
+parser.add_option("--retries", dest="retries", metavar="NUMBER", type="int",
+                  default = 3,
+                  help="Number of retries of a failed injection. Default: %default")
+parser.add_option("--backoff", dest="backoff", metavar="SECONDS", type="float",
+                  default = 300,
+                  help="Delay before the first retry. It's doubled with every next retry and randomized by +-50%. Default: %default")
+parser.add_option("--report", dest="report", metavar="FILE",
+                  help="Write per-dataset report in JSON Lines format, or CSV if FILE ends with .csv")
+parser.add_option("--shard", dest="shard", metavar="i/N",
+                  help="Process only shard i (counting from 0) of N. Datasets are assigned to shards by a hash of their names, so N jobs with i=0..N-1 cover every dataset exactly once.")
+instrumentation.add_options(parser)
+governor.add_options(parser)
+
 (options, args) = parser.parse_args()
+instrumentation.setup(options)
+governor.setup(options)
+
+shard = None
+if options.shard:
+     try:
+          shard = dbs_tools.parse_shard(options.shard)
+     except ValueError, e:
+          print "ERROR: %s" % e
+          sys.exit(1)
+
+if options.connections < 1:
+     print "ERROR: --connections must be at least 1"
+     sys.exit(1)
 
-proxyCertificate = "/tmp/x509up_u11792"
+proxyCertificate = options.proxy
 capath = "/etc/grid-security/certificates"
+phedex = http_client.HttpClient(proxyCertificate, capath, max_connections=options.connections,
+                                 operation="phedex", governor=governor.get(options.phedex_url))
 
 if not options.injector:
      print "ERROR: injector path is not set"
@@ -48,7 +96,7 @@ if not options.injector:
      sys.exit(1)
 
 if not options.run and not options.era:
-     print "ERROR: need either RUN number or Era name specified"
+     print "ERROR: need either RUN numbers or Era names specified"
      parser.print_help()
      sys.exit(1)
 
@@ -61,17 +109,20 @@ datatiers = None
 if options.tiers:
      datatiers = options.tiers.split(',')
 
+runs = dbs_tools.split_list(options.run)
+eras = dbs_tools.split_list(options.era)
+
 logfile = None
 if options.log:
      tiers = re.sub(',',"_",options.tiers)
-     period = None
-     if options.run: period = options.run
-     if options.era: period = options.era
+     period = dbs_tools.get_period_name(runs, eras)
      processing_type = "full_check"
      if options.execute:
           processing_type = "execute"
      if options.check:
           processing_type = "simple_check"
+     if shard:
+          period += "-shard%dof%d" % shard
      logfile = "%s-%s-%s-%d.log" % (
           period, tiers, processing_type, int(time.time()))
      print "All output is redirected to %s" % logfile
@@ -86,109 +137,119 @@ def form_subscription_report(subscription):
      return "node: %-20s fraction: %-3s%%  custodial: %1s group %-20s" % (
           subscription['node'],subscription['percent_bytes'],subscription['custodial'],subscription['group'])
 
-def get_subscription_information(dataset):
-     report = {'nAnalysisOps':0,'nComplete':0,'PhEDEx':False,'nAnalysisOpsComplete':0}
-     storage = StringIO()
-     curl = pycurl.Curl()
-     url = "https://cmsweb.cern.ch/phedex/datasvc/json/prod/subscriptions?dataset=%s" % dataset
-     # print url
-     curl.setopt(pycurl.URL, str(url))
-     curl.setopt(pycurl.SSL_VERIFYPEER, 1)
-     curl.setopt(pycurl.SSL_VERIFYHOST, 2)
-     curl.setopt(pycurl.CAINFO, proxyCertificate)
-     curl.setopt(pycurl.CAPATH, capath)
-     curl.setopt(pycurl.SSLKEY, proxyCertificate)
-     curl.setopt(pycurl.SSLCERT, proxyCertificate)
-     curl.setopt(curl.WRITEFUNCTION, storage.write)
-     curl.perform()
-     # make a dictitionary out of the json
-     data = json.loads(storage.getvalue())
-     # pprint.pprint(data)
+def new_report():
+     return {'nAnalysisOps':0,'nComplete':0,'PhEDEx':False,'nAnalysisOpsComplete':0,'log':[]}
+
+def get_subscription_information(record):
+     """Classify subscriptions of a PhEDEx dataset record as soon as it's
+     parsed. Only the counts and the log lines are kept."""
+     report = new_report()
      try:
-          datasets = data['phedex']['dataset']
-          if len(datasets)==0:
-               summary["NotInPhedex"].append(dataset)
-               print "No information in PhEDEx about this dataset"
-               return report
-          if len(datasets)!=1:
-               raise Exception("Unpexpected number of datasets is returned")
           report['PhEDEx'] = True
-          subscriptions = datasets[0]['subscription']
-          for subscription in subscriptions:
+          for subscription in record['subscription']:
                incomplete = (subscription['percent_bytes']==None) or (subscription['percent_bytes'] < 100)
                if not incomplete: report['nComplete'] += 1
                if subscription['group']=='AnalysisOps': 
                     report['nAnalysisOps'] += 1
                     if not incomplete: report['nAnalysisOpsComplete'] += 1
-               print form_subscription_report(subscription)
+               report['log'].append(form_subscription_report(subscription))
      except KeyError:
           pass
      return report
 
-def run_command(command):
-     # flash stdout to keep order of messages right
-     sys.stdout.flush()
-     exit_code = subprocess.call(command, shell=True)
-     return exit_code
-     
+def get_dataset_report(dataset, reports):
+     report = reports.get(dataset)
+     if report==None:
+          summary["NotInPhedex"].append(dataset)
+          print "No information in PhEDEx about this dataset"
+          return new_report()
+     for line in report['log']:
+          print line
+     return report
+
 
 # DBS reader
 url = "https://cmsweb.cern.ch/dbs/prod/global/DBSReader"
-api = DbsApi(url=url)
+api = dbs_tools.get_api(url)
 
-datasets = []
-
-if options.run:
-     datasets = api.listDatasets(run_num=options.run, detail=True)
-if options.era:
-     datasets = api.listDatasets(acquisition_era_name=options.era, detail=True)
+# Datasets matching several runs or eras are processed only once
+counts = {'duplicates':0}
+datasets = list(dbs_tools.list_datasets(api, dbs_tools.get_queries(runs, eras), counts=counts))
 
 print "Total number of datasets: %d" % len(datasets)
-nDatasetsToCheck = 0
+if len(runs) + len(eras) > 1:
+     print "Number of datasets found for more than one run or era: %d" % counts['duplicates']
+datasets_to_check = []
 for ds in datasets:
      if datatiers and not ds['data_tier_name'] in datatiers:
           continue
-     nDatasetsToCheck += 1
+     if shard and not dbs_tools.in_shard(ds['dataset'], shard):
+          continue
+     datasets_to_check.append(ds)
+nDatasetsToCheck = len(datasets_to_check)
 print "Number of datasets to check: %d" % nDatasetsToCheck
 
 
-for ds in datasets:
-     if datatiers and not ds['data_tier_name'] in datatiers:
-          continue
-     print "\nDatset:",ds['dataset'],
-     blocks = api.listBlockSummaries(dataset = ds['dataset'])
-     ds_size = blocks[0]['file_size']/pow(2,30)
-     print " \t %0.0f GB" % (ds_size)
-     if options.size:
-          ds_size = options.size
+scheduler = injection_scheduler.InjectionScheduler(options.jobs, options.retries, options.backoff)
 
+# Per-dataset records are written as soon as a dataset is processed
+dataset_report = None
+if options.report:
+     dataset_report = dataset_report_module.DatasetReport(options.report, ['dataset', 'size', 'status', 'command'])
+
+# PhEDEx information and dataset sizes are fetched concurrently in bulk for a group of datasets at a time
+dataset_sizes = dbs_tools.DatasetSizes(lambda: dbs_tools.make_api(url), options.dbs_jobs)
+for ds_group in dbs_tools.chunks(datasets_to_check, options.connections*options.phedex_chunk):
+     reports = dict()
+     def add_report(record):
+          reports[record['name']] = get_subscription_information(record)
      if options.phedex:
-          report = get_subscription_information(ds['dataset'])
-          if report['nComplete']==0:
-               summary["NoCompleteCopyAnywhere"].append(ds['dataset'])  
-          if report['nAnalysisOpsComplete']==0:
-               summary["MayGetLost"].append(ds['dataset'])  
-          if int(options.copies)>0:
-               n = report['nAnalysisOps']
-               if n >= int(options.copies):
-                    continue
-               else:
-                    print "Need to inject the dataset in DDM: %d out of %d copies are found" % (n,int(options.copies))
-                    summary["NotFullyInjected"].append(ds['dataset'])
+          phedex_api.get_subscriptions(phedex, options.phedex_url, [ds['dataset'] for ds in ds_group], add_report, options.phedex_chunk)
+     ds_sizes = dataset_sizes.get([ds['dataset'] for ds in ds_group])
+     for ds in ds_group:
+          print "\nDatset:",ds['dataset'],
+          ds_size = ds_sizes[ds['dataset']]/pow(2,30)
+          print " \t %0.0f GB" % (ds_size)
+          if options.size:
+               ds_size = options.size
 
-     if options.check:
-          continue
+          status = []
+          inject = not options.check
+          if options.phedex:
+               report = get_dataset_report(ds['dataset'], reports)
+               if not report['PhEDEx']:
+                    status.append("NotInPhedex")
+               if report['nComplete']==0:
+                    summary["NoCompleteCopyAnywhere"].append(ds['dataset'])  
+                    status.append("NoCompleteCopyAnywhere")
+               if report['nAnalysisOpsComplete']==0:
+                    summary["MayGetLost"].append(ds['dataset'])  
+                    status.append("MayGetLost")
+               if int(options.copies)>0:
+                    n = report['nAnalysisOps']
+                    if n >= int(options.copies):
+                         inject = False
+                    else:
+                         print "Need to inject the dataset in DDM: %d out of %d copies are found" % (n,int(options.copies))
+                         summary["NotFullyInjected"].append(ds['dataset'])
+                         status.append("NotFullyInjected")
 
-     command = "%s --dataset=%s --nCopies=%d --expectedSizeGb=%d" % (options.injector,ds['dataset'],int(options.copies),int(ds_size))
-     if options.execute:
-          command = command + " --exec"
-     print command
-     if run_command(command):
-          print "Command failed. Sleep for 5 mins and retry"
-          time.sleep(300)
-          if run_command(command):
-               print "ERROR: permanent error. Cannot proceed."
-               sys.exit(1)
+          command = None
+          if inject:
+               command = "%s --dataset=%s --nCopies=%d --expectedSizeGb=%d" % (options.injector,ds['dataset'],int(options.copies),int(ds_size))
+               if options.execute:
+                    command = command + " --exec"
+               print command
+               sys.stdout.flush()
+               scheduler.submit(ds['dataset'], command)
+          if dataset_report:
+               dataset_report.add({'dataset':ds['dataset'], 'size':ds_sizes[ds['dataset']],
+                                   'status':status or ["OK"], 'command':command})
+dataset_sizes.close()
+phedex.close()
+if dataset_report:
+     dataset_report.close()
+failed_injections = scheduler.wait()
 # pprint.pprint(summary)
 print "NotInPhedex:"
 pprint.pprint(summary["NotInPhedex"])
@@ -201,3 +262,8 @@ print "Number of datasets registered in DBS, but missing in PhEDEx: %d" % (len(s
 print "Number of datasets without complete copy: %d" % (len(summary["NoCompleteCopyAnywhere"]))
 print "Number of datasets that may get lost: %d" % (len(summary["MayGetLost"]))
 print "Number of datasets that are not fully injected in DDM:  %d" % (len(summary["NotFullyInjected"]))
+if len(failed_injections)>0:
+     print "ERROR: injection failed for %d datasets:" % len(failed_injections)
+     for job in failed_injections:
+          print "\t%s" % job.name
+     sys.exit(1)
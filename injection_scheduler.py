@@ -0,0 +1,84 @@
+"""
+Execution of injector commands with a bounded number of concurrent
+processes. A failed command is retried after an exponentially growing
+delay with random jitter, while other commands keep running. Output of
+each attempt is captured in a temporary file and written to the log as
+one piece once the attempt is finished, so outputs never interleave.
+"""
+import sys, time, random, subprocess, tempfile
+
+class Job(object):
+     def __init__(self, name, command):
+          self.name = name
+          self.command = command
+          self.attempts = 0
+          self.not_before = 0
+          self.process = None
+          self.output = None
+          self.exit_code = None
+
+class InjectionScheduler(object):
+     def __init__(self, max_running=4, max_retries=3, backoff=300, max_backoff=3600):
+          self.max_running = max_running
+          self.max_retries = max_retries
+          self.backoff = backoff
+          self.max_backoff = max_backoff
+          self.queue = []
+          self.running = []
+          self.done = []
+          self.failed = []
+
+     def submit(self, name, command):
+          self.queue.append(Job(name, command))
+          self.poll()
+
+     def _start(self, job):
+          job.attempts += 1
+          job.output = tempfile.TemporaryFile()
+          job.process = subprocess.Popen(job.command, shell=True, stdout=job.output, stderr=subprocess.STDOUT)
+          self.running.append(job)
+
+     def _finish(self, job):
+          job.exit_code = job.process.returncode
+          job.output.seek(0)
+          out = sys.stdout
+          out.write("\n==> %s (attempt %d, exit code %d)\n" % (job.command, job.attempts, job.exit_code))
+          out.write(job.output.read())
+          out.flush()
+          job.output.close()
+          job.output = None
+          job.process = None
+          if job.exit_code == 0:
+               self.done.append(job)
+          elif job.attempts <= self.max_retries:
+               delay = min(self.max_backoff, self.backoff * pow(2, job.attempts-1))
+               delay *= random.uniform(0.5, 1.5)
+               job.not_before = time.time() + delay
+               out.write("Command failed. Retry in %0.0f seconds\n" % delay)
+               out.flush()
+               self.queue.append(job)
+          else:
+               out.write("ERROR: permanent error for %s after %d attempts\n" % (job.name, job.attempts))
+               out.flush()
+               self.failed.append(job)
+
+     def poll(self):
+          """Collect finished jobs and start queued ones. Doesn't block."""
+          for job in list(self.running):
+               if job.process.poll() != None:
+                    self.running.remove(job)
+                    self._finish(job)
+          now = time.time()
+          for job in list(self.queue):
+               if len(self.running) >= self.max_running: break
+               if job.not_before <= now:
+                    self.queue.remove(job)
+                    self._start(job)
+
+     def wait(self, interval=1.0):
+          """Wait until all jobs are finished. Returns list of failed jobs."""
+          while len(self.queue)>0 or len(self.running)>0:
+               self.poll()
+               if len(self.queue)>0 or len(self.running)>0:
+                    time.sleep(interval)
+          return self.failed
@@ -0,0 +1,180 @@
+"""
+Timing of remote operations. Every DBS, PhEDEx and storage call records
+its latency in a histogram together with call, error and byte counts per
+operation type. The summary can be exported at the end of a run as JSON
+or as a Prometheus text file (file names ending with .prom).
+
+Worker processes send their measurements back with take() and the parent
+adds them with merge().
+"""
+import time, json, atexit, threading, contextlib
+
+# additional summaries included in the export: name -> function returning
+# a dictionary of objects with numeric properties, e.g. endpoint -> state
+sections = dict()
+
+# upper bounds of latency histogram buckets in seconds
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+class Metrics(object):
+     def __init__(self):
+          self.lock = threading.Lock()
+          self.stats = dict()
+
+     def _new_stats(self):
+          return {'count':0, 'errors':0, 'time':0.0, 'bytes':0, 'histogram':[0] * (len(buckets)+1)}
+
+     def record(self, operation, elapsed, nbytes=0, error=False):
+          with self.lock:
+               if operation not in self.stats:
+                    self.stats[operation] = self._new_stats()
+               stats = self.stats[operation]
+               stats['count'] += 1
+               stats['time'] += elapsed
+               stats['bytes'] += nbytes
+               if error: stats['errors'] += 1
+               i = 0
+               while i < len(buckets) and elapsed > buckets[i]:
+                    i += 1
+               stats['histogram'][i] += 1
+
+     @contextlib.contextmanager
+     def timed(self, operation):
+          """Measure a block of code. Bytes transferred can be added to
+          call['bytes'] of the yielded dictionary."""
+          call = {'bytes':0}
+          start = time.time()
+          try:
+               yield call
+          except:
+               self.record(operation, time.time()-start, call['bytes'], True)
+               raise
+          self.record(operation, time.time()-start, call['bytes'])
+
+     def take(self):
+          """Return measurements and start from scratch"""
+          with self.lock:
+               stats = self.stats
+               self.stats = dict()
+          return stats
+
+     def merge(self, stats):
+          with self.lock:
+               for operation, other in stats.items():
+                    if operation not in self.stats:
+                         self.stats[operation] = self._new_stats()
+                    mine = self.stats[operation]
+                    for key in ['count', 'errors', 'time', 'bytes']:
+                         mine[key] += other[key]
+                    mine['histogram'] = [a+b for a, b in zip(mine['histogram'], other['histogram'])]
+
+     def summary(self):
+          with self.lock:
+               summary = dict()
+               for operation, stats in self.stats.items():
+                    summary[operation] = {'count':stats['count'], 'errors':stats['errors'],
+                                          'total_time':stats['time'], 'bytes':stats['bytes'],
+                                          'mean_time':stats['time']/stats['count'] if stats['count'] else 0,
+                                          'histogram':dict(zip([str(b) for b in buckets] + ['+Inf'], stats['histogram']))}
+               return summary
+
+     def write_json(self, path):
+          with open(path, 'w') as f:
+               data = {'timestamp':time.time(), 'operations':self.summary()}
+               for name, function in sections.items():
+                    data[name] = function()
+               json.dump(data, f, indent=2, sort_keys=True)
+
+     def write_prometheus(self, path):
+          lines = ["# HELP dbs3tools_call_duration_seconds Latency of remote operations",
+                   "# TYPE dbs3tools_call_duration_seconds histogram"]
+          with self.lock:
+               operations = sorted(self.stats.items())
+          for operation, stats in operations:
+               total = 0
+               for bound, count in zip(buckets, stats['histogram']):
+                    total += count
+                    lines.append('dbs3tools_call_duration_seconds_bucket{operation="%s",le="%s"} %d' % (operation, bound, total))
+               lines.append('dbs3tools_call_duration_seconds_bucket{operation="%s",le="+Inf"} %d' % (operation, stats['count']))
+               lines.append('dbs3tools_call_duration_seconds_sum{operation="%s"} %f' % (operation, stats['time']))
+               lines.append('dbs3tools_call_duration_seconds_count{operation="%s"} %d' % (operation, stats['count']))
+          lines += ["# HELP dbs3tools_call_errors_total Failed remote operations",
+                    "# TYPE dbs3tools_call_errors_total counter"]
+          for operation, stats in operations:
+               lines.append('dbs3tools_call_errors_total{operation="%s"} %d' % (operation, stats['errors']))
+          lines += ["# HELP dbs3tools_bytes_total Bytes transferred by remote operations",
+                    "# TYPE dbs3tools_bytes_total counter"]
+          for operation, stats in operations:
+               lines.append('dbs3tools_bytes_total{operation="%s"} %d' % (operation, stats['bytes']))
+          for section, function in sorted(sections.items()):
+               for name, values in sorted(function().items()):
+                    for key, value in sorted(values.items()):
+                         lines.append('dbs3tools_%s_%s{name="%s"} %s' % (section, key, name, value))
+          with open(path, 'w') as f:
+               f.write("\n".join(lines) + "\n")
+
+     def write(self, path):
+          if path.endswith(".prom"):
+               self.write_prometheus(path)
+          else:
+               self.write_json(path)
+
+metrics = Metrics()
+
+def timed(operation):
+     return metrics.timed(operation)
+
+class InstrumentedApi(object):
+     """Wrapper timing every public method call of an API object"""
+     def __init__(self, api, prefix):
+          self._api = api
+          self._prefix = prefix
+
+     def __getattr__(self, name):
+          attr = getattr(self._api, name)
+          if name.startswith('_') or not callable(attr):
+               return attr
+          operation = "%s.%s" % (self._prefix, name)
+          def call(*args, **kwargs):
+               with timed(operation):
+                    return attr(*args, **kwargs)
+          return call
+
+profiler = None
+exit_handlers = []  # (function, args) to run at the end of a run
+
+def start_profile():
+     global profiler
+     import cProfile
+     profiler = cProfile.Profile()
+     profiler.enable()
+
+def stop_profile(path):
+     if profiler:
+          profiler.disable()
+          profiler.dump_stats(path)
+          print "Profile is stored in %s. Use python -m pstats %s to inspect it." % (path, path)
+
+def finish():
+     """Store the profile and export metrics. Called at exit and by
+     runners that leave with os._exit (dbs3toolsd.py, benchmark.py)"""
+     while len(exit_handlers)>0:
+          function, args = exit_handlers.pop()
+          function(*args)
+
+atexit.register(finish)
+
+def add_options(parser):
+     parser.add_option("--metrics", dest="metrics", metavar="FILE",
+                       help="Export timing of remote operations at the end of the run. Prometheus text format if FILE ends with .prom, JSON otherwise.")
+     parser.add_option("--profile", dest="profile", metavar="FILE",
+                       help="Profile the run with cProfile and store statistics in FILE")
+
+def setup(options):
+     """Start profiling and schedule metrics export as requested by
+     --metrics and --profile options"""
+     if options.metrics:
+          exit_handlers.append((metrics.write, (options.metrics,)))
+     if options.profile:
+          start_profile()
+          exit_handlers.append((stop_profile, (options.profile,)))
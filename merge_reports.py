@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import sys
+from optparse import OptionParser
+import dataset_report
+
+description = """
+Merge per-dataset reports of check_data_availability.py or
+inject_data_in_DDM.py jobs running with --shard into one report. For
+availability checks the lists of datasets with problems are produced
+from the merged records and the summary has the same counts as a run
+without sharding.
+"""
+parser = OptionParser(usage = "\n\t%prog [options] REPORT...", description = description, epilog= ' ')
+parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                  help="Merged report. JSON Lines format, or CSV if FILE ends with .csv")
+parser.add_option("--lists", dest="lists", metavar="PREFIX",
+                  help="Produce lists of datasets with problems found by check_data_availability.py as PREFIX-below_N.txt etc.")
+parser.add_option("-l", "--lost", dest="lost_fraction", metavar = "NUMBER", type="float",
+                  default = 90,
+                  help="Value of --lost used by the availability check. Default: %default")
+
+(options, args) = parser.parse_args()
+
+if not options.output or len(args)==0:
+     parser.print_help()
+     sys.exit(1)
+
+fields = ['dataset', 'size', 'status']
+for path in args:
+     for record in dataset_report.read_records(path):
+          for field in sorted(record.keys()):
+               if field not in fields:
+                    fields.append(field)
+          break
+
+lists = None
+if options.lists:
+     lists = dataset_report.get_availability_lists(options.lists, options.lost_fraction)
+merged = dataset_report.DatasetReport(options.output, fields, lists)
+seen = set()
+status_counts = dict()
+nDuplicates = 0
+for path in args:
+     for record in dataset_report.read_records(path):
+          if record['dataset'] in seen:
+               # shards of different runs or different N
+               nDuplicates += 1
+               continue
+          seen.add(record['dataset'])
+          merged.add(record)
+          for status in record['status']:
+               status_counts[status] = status_counts.get(status, 0) + 1
+merged.close()
+
+print "Number of datasets: %d" % len(seen)
+for status, count in sorted(status_counts.items()):
+     print "\t%-30s %d" % (status, count)
+if nDuplicates>0:
+     print "WARNING: %d datasets are found in more than one report. Only the first record is kept." % nDuplicates
+if lists:
+     dataset_report.print_availability_summary(merged, options.lost_fraction)
+print "Merged report: %s" % options.output
@@ -0,0 +1,102 @@
+"""
+Local SQLite cache of per-file meta data. It allows to skip reading
+files again when the same set of files is processed several times,
+e.g. a dry run followed by the actual publication.
+
+Entries are keyed by LFN and are valid only if the file size didn't
+change. Entries older than ttl are ignored and the cache is trimmed to
+max_entries by removing least recently used entries. Checksums are kept
+in a separate table, since they are computed only on request.
+"""
+import os, time, array, sqlite3
+
+default_path = os.path.join(os.path.expanduser("~"), ".dbs3tools", "metadata_cache.db")
+
+class MetadataCache(object):
+     def __init__(self, path=default_path, ttl=30*86400, max_entries=200000):
+          self.path = path
+          self.ttl = ttl
+          self.max_entries = max_entries
+          self.pid = None
+          self.db = None
+          directory = os.path.dirname(path)
+          if directory and not os.path.exists(directory):
+               os.makedirs(directory)
+          self._connect().execute("""CREATE TABLE IF NOT EXISTS files (
+                                        lfn TEXT PRIMARY KEY,
+                                        file_size INTEGER,
+                                        event_count INTEGER,
+                                        runs BLOB,
+                                        lumis BLOB,
+                                        created REAL,
+                                        accessed REAL)""")
+          self.db.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                                        lfn TEXT PRIMARY KEY,
+                                        file_size INTEGER,
+                                        adler32 TEXT,
+                                        cksum TEXT,
+                                        created REAL)""")
+          self.db.commit()
+
+     def _connect(self):
+          # SQLite connections cannot be shared between processes
+          if self.db == None or self.pid != os.getpid():
+               self.db = sqlite3.connect(self.path, timeout=60)
+               self.pid = os.getpid()
+          return self.db
+
+     def get(self, lfn, file_size):
+          """Return (event_count, runs, lumis) or None if there is no valid entry"""
+          db = self._connect()
+          row = db.execute("SELECT file_size, event_count, runs, lumis, created FROM files WHERE lfn=?",
+                           (lfn,)).fetchone()
+          if not row: return None
+          size, event_count, runs_blob, lumis_blob, created = row
+          if size != file_size or time.time() - created > self.ttl:
+               return None
+          db.execute("UPDATE files SET accessed=? WHERE lfn=?", (time.time(), lfn))
+          db.commit()
+          runs = array.array('L')
+          runs.fromstring(str(runs_blob))
+          lumis = array.array('L')
+          lumis.fromstring(str(lumis_blob))
+          return (event_count, runs, lumis)
+
+     def put(self, lfn, file_size, event_count, runs, lumis):
+          db = self._connect()
+          now = time.time()
+          db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)",
+                     (lfn, file_size, event_count, buffer(runs.tostring()), buffer(lumis.tostring()), now, now))
+          db.commit()
+
+     def get_checksums(self, lfn, file_size):
+          """Return (adler32, cksum) or None if there is no valid entry"""
+          row = self._connect().execute("SELECT file_size, adler32, cksum, created FROM checksums WHERE lfn=?",
+                                        (lfn,)).fetchone()
+          if not row: return None
+          size, adler32, cksum, created = row
+          if size != file_size or time.time() - created > self.ttl:
+               return None
+          return (str(adler32), str(cksum))
+
+     def put_checksums(self, lfn, file_size, adler32, cksum):
+          db = self._connect()
+          db.execute("INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?)",
+                     (lfn, file_size, adler32, cksum, time.time()))
+          db.commit()
+
+     def evict(self):
+          """Remove expired entries and keep at most max_entries recently used ones"""
+          db = self._connect()
+          db.execute("DELETE FROM files WHERE created<?", (time.time() - self.ttl,))
+          db.execute("""DELETE FROM files WHERE lfn NOT IN
+                        (SELECT lfn FROM files ORDER BY accessed DESC LIMIT ?)""", (self.max_entries,))
+          db.execute("DELETE FROM checksums WHERE lfn NOT IN (SELECT lfn FROM files)")
+          db.commit()
+
+     def purge(self):
+          db = self._connect()
+          db.execute("DELETE FROM files")
+          db.execute("DELETE FROM checksums")
+          db.commit()
+          db.execute("VACUUM")
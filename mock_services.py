@@ -0,0 +1,227 @@
+"""
+Local stand-ins for DBS, PhEDEx and file access used by benchmark.py.
+All of them serve a synthetic set of datasets and files and simulate
+remote access by sleeping for a configurable time on every call.
+
+  FakeDbsApi       - replacement of dbs.apis.dbsClient.DbsApi
+  PhedexServer     - HTTPS server answering PhEDEx subscriptions queries
+  SyntheticStorage - storage backend (see storage.py) for synthetic files
+  fake_root        - minimal ROOT module opening synthetic EDM files
+"""
+import os, time, json, array, types, hashlib, threading, tempfile, subprocess, ssl, urlparse
+import BaseHTTPServer, SocketServer
+
+class SyntheticWorld(object):
+     """Deterministic set of datasets, their subscriptions and files"""
+     def __init__(self, nDatasets=100, nFiles=100, era="Bench2015A", events_per_file=1000, lumis_per_file=20):
+          self.era = era
+          self.events_per_file = events_per_file
+          self.lumis_per_file = lumis_per_file
+          self.datasets = []
+          for i in range(nDatasets):
+               tier = ["AOD", "MINIAOD", "RAW"][i % 3]
+               self.datasets.append({'dataset':"/Primary%06d/%s-v1/%s" % (i, era, tier),
+                                     'data_tier_name':tier,
+                                     'last_modification_date':1440000000 + i})
+          self.files = ["/store/user/bench/SyntheticLHE/file_%06d.root" % i for i in range(nFiles)]
+          self.inserted_blocks = []
+
+     def _hash(self, name):
+          return int(hashlib.md5(name).hexdigest()[:8], 16)
+
+     def dataset_size(self, dataset):
+          return (self._hash(dataset) % 1000 + 1) * pow(2,30)
+
+     def file_size(self, lfn):
+          return self._hash(lfn) % pow(2,30) + pow(2,20)
+
+     def subscriptions(self, dataset):
+          """None if the dataset is unknown to PhEDEx"""
+          h = self._hash(dataset)
+          if h % 20 == 0: return None
+          subscriptions = []
+          for i in range(h % 4 + 1):
+               percent = 100
+               if (h >> i) % 5 == 0: percent = (h >> i) % 100
+               subscriptions.append({'node':"T%d_XX_Site%d" % (i % 3, i), 'percent_bytes':percent,
+                                     'custodial':'y' if i==0 else 'n',
+                                     'group':'AnalysisOps' if (h >> i) % 2 else 'DataOps',
+                                     'time_create':1400000000 + h % 10000000})
+          return subscriptions
+
+class FakeDbsApi(object):
+     """Answers the DBS calls made by the tools from SyntheticWorld"""
+     world = None
+     latency = 0.01
+     lock = threading.Lock()
+
+     def __init__(self, url=None, **kwargs):
+          self.url = url
+
+     def _call(self):
+          time.sleep(self.latency)
+
+     def listDatasets(self, **kwargs):
+          self._call()
+          if 'logical_file_name' in kwargs or 'dataset' in kwargs:
+               return []
+          tier = kwargs.get('data_tier_name')
+          return [dict(ds) for ds in self.world.datasets if not tier or ds['data_tier_name']==tier]
+
+     def listBlockSummaries(self, dataset):
+          self._call()
+          return [{'file_size':self.world.dataset_size(dataset)}]
+
+     def listFileArray(self, **kwargs):
+          self._call()
+          return []
+
+     def listFiles(self, **kwargs):
+          self._call()
+          return []
+
+     def insertPrimaryDataset(self, config):
+          self._call()
+
+     def insertBulkBlock(self, blockDict):
+          # upload time grows with the payload
+          time.sleep(self.latency * (1 + len(blockDict['files'])/100.))
+          with self.lock:
+               self.world.inserted_blocks.append((blockDict['block']['block_name'], len(blockDict['files'])))
+
+def install_fake_dbs(world, latency):
+     """Make 'from dbs.apis.dbsClient import DbsApi' return FakeDbsApi"""
+     FakeDbsApi.world = world
+     FakeDbsApi.latency = latency
+     modules = dict()
+     for name in ['dbs', 'dbs.apis', 'dbs.apis.dbsClient', 'RestClient', 'RestClient.ErrorHandling',
+                  'RestClient.ErrorHandling.RestClientExceptions']:
+          modules[name] = types.ModuleType(name)
+     modules['dbs.apis.dbsClient'].DbsApi = FakeDbsApi
+     modules['RestClient.ErrorHandling.RestClientExceptions'].HTTPError = type('HTTPError', (Exception,), {})
+     return modules
+
+class PhedexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+     protocol_version = "HTTP/1.1"
+
+     def do_GET(self):
+          url = urlparse.urlparse(self.path)
+          datasets = urlparse.parse_qs(url.query).get('dataset', [])
+          time.sleep(self.server.latency)
+          records = []
+          for dataset in datasets:
+               subscriptions = self.server.world.subscriptions(dataset)
+               if subscriptions != None:
+                    records.append({'name':dataset, 'subscription':subscriptions})
+          body = json.dumps({'phedex':{'request_timestamp':time.time(), 'instance':'prod', 'dataset':records}})
+          self.send_response(200)
+          self.send_header("Content-Type", "application/json")
+          self.send_header("Content-Length", str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+
+     def log_message(self, format, *args):
+          pass
+
+class PhedexServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+     """PhEDEx data service stand-in on https://localhost:<port>. A self-signed
+     certificate is generated at start. The same file can be used by clients
+     as the grid proxy and as the CA file."""
+     daemon_threads = True
+
+     def __init__(self, world, latency=0.02):
+          self.directory = tempfile.mkdtemp(prefix="phedex_server")
+          self.certificate = os.path.join(self.directory, "localhost.pem")
+          key = os.path.join(self.directory, "key.pem")
+          cert = os.path.join(self.directory, "cert.pem")
+          subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                                 "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+          with open(self.certificate, 'w') as f:
+               f.write(open(cert).read())
+               f.write(open(key).read())
+          self.world = world
+          self.latency = latency
+          BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0), PhedexHandler)
+          self.socket = ssl.wrap_socket(self.socket, certfile=self.certificate, server_side=True)
+          self.url = "https://localhost:%d/phedex/datasvc/json/prod" % self.server_address[1]
+
+     def start(self):
+          thread = threading.Thread(target=self.serve_forever)
+          thread.daemon = True
+          thread.start()
+
+     def stop(self):
+          self.shutdown()
+          self.server_close()
+
+class SyntheticStorage(object):
+     """Storage backend for synthetic files. Same interface as storage.PosixStorage"""
+     world = None
+     latency = 0.01
+
+     def __init__(self, *args):
+          pass
+
+     def url(self, lfn):
+          return "synthetic://" + lfn
+
+     def stat(self, lfn):
+          time.sleep(self.latency)
+          return self.world.file_size(lfn)
+
+     def failed(self, lfn):
+          return False
+
+class Buffer(array.array):
+     """Stand-in for the double buffer returned by TTree::GetV1"""
+     def SetSize(self, n):
+          pass
+
+class SyntheticTree(object):
+     def __init__(self, entries, runs=None, lumis=None):
+          self.entries = entries
+          self.runs = runs
+          self.lumis = lumis
+     def GetEntries(self):
+          return self.entries
+     def SetEstimate(self, n):
+          pass
+     def Draw(self, expression, selection, option):
+          return self.entries
+     def GetV1(self):
+          return Buffer('d', self.runs)
+     def GetV2(self):
+          return Buffer('d', self.lumis)
+
+class SyntheticFile(object):
+     def __init__(self, world, lfn):
+          self.world = world
+          self.lfn = lfn
+          first = world._hash(lfn) % 100000
+          self.trees = {'Events': SyntheticTree(world.events_per_file),
+                        'LuminosityBlocks': SyntheticTree(world.lumis_per_file,
+                                                          [1.0] * world.lumis_per_file,
+                                                          [float(first + i) for i in range(world.lumis_per_file)])}
+     def IsZombie(self):
+          return False
+     def GetSize(self):
+          return self.world.file_size(self.lfn)
+     def GetBytesRead(self):
+          return 0
+     def Get(self, name):
+          return self.trees.get(name)
+     def Close(self):
+          pass
+
+def fake_root(world, latency):
+     """Module replacing ROOT for file_probe. Opening a file takes latency seconds."""
+     root = types.ModuleType('ROOT')
+     root.gROOT = types.ModuleType('gROOT')
+     root.gROOT.SetBatch = lambda flag: None
+     def open_file(url):
+          time.sleep(latency)
+          return SyntheticFile(world, url[len("synthetic://"):])
+     root.TFile = types.ModuleType('TFile')
+     root.TFile.Open = open_file
+     return root
@@ -0,0 +1,168 @@
+"""
+Bulk queries of PhEDEx data service. Subscriptions of many datasets are
+requested at once using repeated dataset parameters and the response is
+split per dataset locally.
+
+Responses are parsed incrementally as they arrive. Subscriptions of a
+dataset are decoded one by one and the dataset record is passed to a
+callback as soon as it's complete, so neither the raw response nor the
+full object tree is kept in memory.
+"""
+import re, json, urllib
+import dbs_tools, governor, http_client
+
+default_url = "https://cmsweb.cern.ch/phedex/datasvc/json/prod"
+
+def get_subscriptions_url(base_url, datasets):
+     return "%s/subscriptions?%s" % (base_url, urllib.urlencode([('dataset', ds) for ds in datasets]))
+
+class InvalidResponse(http_client.HttpError):
+     """Response that is not a complete PhEDEx document, e.g. a truncated
+     body or an HTML page"""
+     def __init__(self, url, message):
+          Exception.__init__(self, "Invalid response to HTTP request %s: %s" % (url, message))
+          self.url = url
+          self.code = None
+
+class DatasetStreamParser(object):
+     """Push parser for PhEDEx responses. Feed it with chunks of the
+     response and callback(record) is called for every dataset record.
+     Only subscription objects are decoded, one at a time. Of the other
+     fields of a dataset record only strings (e.g. name) are kept, so
+     block lists are skipped without being stored. close() checks that
+     the response was complete."""
+     special = re.compile(r'[{}\[\]":,]')
+     string_special = re.compile(r'["\\]')
+     phedex_path = [None, 'phedex']
+     dataset_path = [None, 'phedex', 'dataset', None]
+     subscription_path = [None, 'phedex', 'dataset', None, 'subscription', None]
+
+     def __init__(self, callback):
+          self.callback = callback
+          self.path = []          # key of each open container in its parent
+          self.keys = []          # last key seen in each open container
+          self.in_string = False
+          self.escape = False
+          self.string_parts = []
+          self.last_string = None
+          self.after_colon = False
+          self.seen_phedex = False
+          self.record = None      # dataset record being read
+          self.capture = None     # pieces of the subscription being read
+          self.capture_depth = 0
+          self.nRecords = 0
+
+     def feed(self, data):
+          pos = 0
+          capture_start = 0
+          while pos < len(data):
+               if self.in_string:
+                    if self.escape:
+                         self.escape = False
+                         if self.capture == None: self.string_parts.append(data[pos])
+                         pos += 1
+                         continue
+                    match = self.string_special.search(data, pos)
+                    end = match.start() if match else len(data)
+                    if self.capture == None: self.string_parts.append(data[pos:end])
+                    if not match:
+                         break
+                    pos = match.end()
+                    if match.group() == '\\':
+                         self.escape = True
+                         if self.capture == None: self.string_parts.append('\\')
+                    else:
+                         self.in_string = False
+                         if self.capture == None:
+                              self.last_string = json.loads('"%s"' % ''.join(self.string_parts))
+                              if self.after_colon and self.record != None and self.path == self.dataset_path:
+                                   self.record[self.keys[-1]] = self.last_string
+                              self.after_colon = False
+                    continue
+               match = self.special.search(data, pos)
+               if not match:
+                    break
+               c = match.group()
+               pos = match.end()
+               if c == '"':
+                    self.in_string = True
+                    self.string_parts = []
+               elif c == ':':
+                    if self.capture == None and len(self.keys)>0:
+                         self.keys[-1] = self.last_string
+                         self.after_colon = True
+               elif c == ',':
+                    # the value was a number, true, false or null
+                    self.after_colon = False
+               elif c in '{[':
+                    self.after_colon = False
+                    key = None
+                    if len(self.keys)>0: key = self.keys[-1]
+                    self.path.append(key)
+                    self.keys.append(None)
+                    if self.capture != None:
+                         continue
+                    if c == '{' and self.path == self.phedex_path:
+                         self.seen_phedex = True
+                    elif c == '{' and self.path == self.dataset_path:
+                         self.record = dict()
+                    elif c == '[' and self.record != None and self.path == self.dataset_path + ['subscription']:
+                         self.record['subscription'] = []
+                    elif c == '{' and self.record != None and self.path == self.subscription_path:
+                         self.capture = []
+                         self.capture_depth = len(self.path)
+                         capture_start = match.start()
+               else:
+                    if len(self.path) == 0:
+                         raise ValueError("unbalanced '%s' in PhEDEx response" % c)
+                    self.after_colon = False
+                    if self.capture != None and len(self.path) == self.capture_depth:
+                         self.capture.append(data[capture_start:pos])
+                         self.record['subscription'].append(json.loads(''.join(self.capture)))
+                         self.capture = None
+                    elif self.record != None and self.path == self.dataset_path:
+                         record = self.record
+                         self.record = None
+                         self.nRecords += 1
+                         self.callback(record)
+                    self.path.pop()
+                    self.keys.pop()
+          if self.capture != None:
+               self.capture.append(data[capture_start:])
+
+     def close(self):
+          """Raise ValueError unless a complete PhEDEx document was parsed.
+          Truncated responses, HTML pages and redirects produce no records
+          and would otherwise look like datasets unknown to PhEDEx."""
+          if self.in_string or len(self.path)>0:
+               raise ValueError("truncated PhEDEx response")
+          if not self.seen_phedex:
+               raise ValueError("no phedex object in the response")
+
+def get_subscriptions(client, base_url, datasets, callback, chunk_size=25):
+     """Query subscriptions of datasets with chunk_size datasets per request.
+     Requests are performed concurrently by the client and callback(record)
+     is called for every PhEDEx dataset record as soon as it's parsed.
+     Datasets unknown to PhEDEx produce no callback. Requests throttled by
+     the service are retried. Incomplete or invalid responses raise
+     InvalidResponse."""
+     urls = [get_subscriptions_url(base_url, ds_chunk) for ds_chunk in dbs_tools.chunks(datasets, chunk_size)]
+     attempt = 0
+     while len(urls)>0:
+          parsers = [DatasetStreamParser(callback) for url in urls]
+          throttled = []
+          for url, parser, response in zip(urls, parsers, client.get_many(urls, [parser.feed for parser in parsers])):
+               if isinstance(response, Exception):
+                    if not governor.is_throttled(response) or attempt >= governor.defaults['retries']:
+                         raise response
+                    throttled.append(url)
+                    continue
+               try:
+                    parser.close()
+               except ValueError, e:
+                    raise InvalidResponse(url, str(e))
+          # requests rejected by the service are repeated after a delay
+          if len(throttled)>0:
+               governor.backoff(attempt)
+               attempt += 1
+          urls = throttled
@@ -0,0 +1,99 @@
+"""
+Thread based processing pipeline. Items produced by a source flow
+through stages connected by bounded queues. Stages run concurrently,
+each in one or more threads, so network bound steps overlap and the
+first results are available long before the source is exhausted.
+
+     pipeline = Pipeline(source)
+     pipeline.add_stage(lookup, threads=10)
+     pipeline.add_stage(bulk_query, batch_size=250)
+     for item in pipeline.run():
+          ...
+
+A stage function gets a list of items and returns a list of items for
+the next stage. Exceptions raised in any thread are re-raised by run().
+"""
+import sys, threading, Queue
+
+end = object()  # marks the end of the stream in a queue
+
+def get_batch(queue, size):
+     """Wait for an item and take up to size-1 more that are already
+     queued. Batches are small when items arrive slowly, so nothing waits
+     for a batch to fill up."""
+     items = [queue.get()]
+     while len(items) < size and items[-1] is not end:
+          try:
+               items.append(queue.get_nowait())
+          except Queue.Empty:
+               break
+     return items
+
+class Pipeline(object):
+     def __init__(self, source, queue_size=1000):
+          self.source = source
+          self.queue_size = queue_size
+          self.stages = []
+          self.failure = None
+          self.lock = threading.Lock()
+
+     def add_stage(self, function, threads=1, batch_size=1):
+          self.stages.append({'function':function, 'threads':threads, 'batch_size':batch_size})
+          return self
+
+     def _feed(self, output):
+          try:
+               for item in self.source:
+                    if self.failure: break
+                    output.put(item)
+          except:
+               self.failure = sys.exc_info()
+          output.put(end)
+
+     def _work(self, stage, input, output):
+          while True:
+               batch = get_batch(input, stage['batch_size'])
+               finished = batch[-1] is end
+               if finished:
+                    batch.pop()
+                    # let other threads of the stage see the end too
+                    input.put(end)
+               if len(batch)>0 and not self.failure:
+                    try:
+                         for item in stage['function'](batch):
+                              output.put(item)
+                    except:
+                         self.failure = sys.exc_info()
+               # after a failure input is still consumed, so that
+               # upstream threads don't block on a full queue
+               if finished: break
+          with self.lock:
+               stage['running'] -= 1
+               if stage['running'] == 0:
+                    output.put(end)
+
+     def _start(self, target, *args):
+          thread = threading.Thread(target=target, args=args)
+          thread.daemon = True
+          thread.start()
+
+     def run(self):
+          """Start all threads and yield items leaving the last stage"""
+          queue = Queue.Queue(self.queue_size)
+          self._start(self._feed, queue)
+          for stage in self.stages:
+               output = Queue.Queue(self.queue_size)
+               stage['running'] = stage['threads']
+               for i in range(stage['threads']):
+                    self._start(self._work, stage, queue, output)
+               queue = output
+          while True:
+               try:
+                    # wait with timeout to stay responsive to Ctrl-C
+                    item = queue.get(True, 1)
+               except Queue.Empty:
+                    continue
+               if item is end: break
+               yield item
+          if self.failure:
+               raise self.failure[0], self.failure[1], self.failure[2]
@@ -0,0 +1,101 @@
+"""
+Journal of a publication. Every processed file and every block upload
+is appended to a local file as one JSON record per line, so that an
+interrupted publication can be resumed without reading files that are
+already processed or uploading blocks that are already in DBS.
+
+Record types:
+  dataset - dataset name chosen for the publication. When several
+            datasets are published in one run, each has a group key
+  file    - meta data of a processed file. Lumi sections are stored as
+            [run, first lumi, last lumi] ranges
+  block   - block upload state: uploading, uploaded or failed
+  done    - publication is complete
+"""
+import os, json, hashlib, threading
+
+default_directory = os.path.join(os.path.expanduser("~"), ".dbs3tools", "journals")
+
+def get_default_path(lfns):
+     """Journal name depends only on the list of input files"""
+     digest = hashlib.md5("\n".join(sorted(lfns))).hexdigest()
+     return os.path.join(default_directory, "%s.journal" % digest)
+
+class PublicationJournal(object):
+     def __init__(self, path):
+          self.path = path
+          self.dataset = None
+          self.datasets = dict()    # group key -> dataset name
+          self.done = False
+          self.files = dict()
+          self.uploaded_files = set()
+          self.blocks = dict()
+          # blocks may be uploaded from several threads
+          self.lock = threading.Lock()
+          if os.path.exists(path):
+               self._load()
+
+     def _load(self):
+          with open(self.path) as f:
+               for line in f:
+                    try:
+                         record = json.loads(line)
+                    except ValueError:
+                         # last line may be incomplete if the process was killed
+                         continue
+                    if record['type'] == 'dataset':
+                         self.datasets[record.get('group')] = record['dataset']
+                         self.dataset = self.datasets.get(None)
+                    elif record['type'] == 'file':
+                         if 'lumis' in record:
+                              # journals written before lumi ranges were introduced
+                              record['lumi_ranges'] = [[run, lumi, lumi] for run, lumi in record.pop('lumis')]
+                         self.files[record['lfn']] = record
+                    elif record['type'] == 'block':
+                         self.blocks[record['block_name']] = record
+                         if record['status'] == 'uploaded':
+                              self.uploaded_files.update(record['lfns'])
+                    elif record['type'] == 'done':
+                         self.done = True
+
+     def _write(self, record):
+          directory = os.path.dirname(self.path)
+          if directory and not os.path.exists(directory):
+               os.makedirs(directory)
+          with self.lock:
+               with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+     def reset(self):
+          """Start a new publication from scratch"""
+          if os.path.exists(self.path):
+               os.remove(self.path)
+          self.__init__(self.path)
+
+     def set_dataset(self, dataset, group=None):
+          self.datasets[group] = dataset
+          self.dataset = self.datasets.get(None)
+          record = {'type':'dataset', 'dataset':dataset}
+          if group != None:
+               record['group'] = group
+          self._write(record)
+
+     def add_file(self, lfn, event_count, file_size, lumi_ranges, adler32=None, check_sum=None):
+          record = {'type':'file', 'lfn':lfn, 'event_count':event_count,
+                    'file_size':file_size, 'lumi_ranges':lumi_ranges,
+                    'adler32':adler32, 'check_sum':check_sum}
+          self.files[lfn] = record
+          self._write(record)
+
+     def set_block_status(self, block_name, lfns, status):
+          record = {'type':'block', 'block_name':block_name, 'lfns':lfns, 'status':status}
+          self.blocks[block_name] = record
+          if status == 'uploaded':
+               self.uploaded_files.update(lfns)
+          self._write(record)
+
+     def set_done(self):
+          self.done = True
+          self._write({'type':'done'})
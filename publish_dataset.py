@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 from dbs.apis.dbsClient import DbsApi
-import sys,time,uuid,commands,re,pprint,os
+import sys,time,uuid,re,pprint,os,multiprocessing,itertools,collections,threading
+from multiprocessing.pool import ThreadPool
 from RestClient.ErrorHandling.RestClientExceptions import HTTPError
 from optparse import OptionParser
+import dbs_tools, instrumentation, governor, publication_journal, storage as storage_module
+import metadata_cache as metadata_cache_module, checksums as checksums_module
 
 description = """
 Simple tool to publish a set of files in DBS3. Minimal support for
@@ -12,12 +15,24 @@ issues and complex cases. Dataset name format:
                                           
 Version number is auto-assigned by based on already published dataset
 names.
+
+Many datasets can be published in one run. With --by-directory files
+are grouped by directory and each directory becomes a dataset named
+after it. A manifest gives the dataset of every file explicitly, one
+'NAME LFN' pair per line, where NAME is either a primary dataset name
+or a full dataset name. Version numbers of all new datasets are looked
+up with one DBS query and meta data of all files is extracted by the
+same pool of workers.
 """
 parser = OptionParser(usage = "\n\t%prog [options]", description = description, epilog= ' ')
 parser.add_option("-l", "--list", dest="files", metavar="FILES",
                   help="Comma separated list of logical file names to publish without whitespaces.")
 parser.add_option("-f", "--file", dest="file", metavar="FILE",
                   help="File that contains a list of files to be published.")
+parser.add_option("-m", "--manifest", dest="manifest", metavar="FILE",
+                  help="File with 'NAME LFN' lines. Files with the same NAME are published in one dataset. NAME is a primary dataset name or a full dataset name.")
+parser.add_option("--by-directory", dest="by_directory", action="store_true", default=False,
+                  help="Publish files of each directory in a separate dataset with the directory name as primary dataset name")
 parser.add_option("-p", "--primary", dest="primary_ds", metavar="PD",
                   help="Primary dataset name (first part of the dataset name). By default common part of the file names is used.")
 parser.add_option("-c", "--campaign", dest="campaign", metavar="TEXT", default="RunIIWinter15pLHE",
@@ -32,6 +47,40 @@ parser.add_option("-d", "--dataset", dest="dataset", metavar="NAME",
                   help="Specify publication dataset explicitely")
 parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
                   help="Show debugging information")
+parser.add_option("-j", "--jobs", dest="jobs", metavar="N", type="int", default=1,
+                  help="Number of files processed in parallel when extracting meta data. Default: %default")
+parser.add_option("--upload-jobs", dest="upload_jobs", metavar="N", type="int", default=1,
+                  help="Number of blocks uploaded to DBS in parallel. Default: %default")
+parser.add_option("--max-files-per-block", dest="max_files_per_block", metavar="N", type="int", default=500,
+                  help="Maximum number of files in one block. Default: %default")
+parser.add_option("--max-block-size", dest="max_block_size", metavar="GB", type="float", default=1000,
+                  help="Maximum block size in GB. Default: %default")
+parser.add_option("--dbs-chunk", dest="dbs_chunk", metavar="N", type="int", default=200,
+                  help="Number of files per DBS request when checking which files are already known. Default: %default")
+parser.add_option("--cache-file", dest="cache_file", metavar="FILE", default=metadata_cache_module.default_path,
+                  help="Local cache of file meta data shared between runs. Default: %default")
+parser.add_option("--cache-ttl", dest="cache_ttl", metavar="DAYS", type="float", default=30,
+                  help="Cache entries older than DAYS are not used. Default: %default")
+parser.add_option("--cache-max-entries", dest="cache_max_entries", metavar="N", type="int", default=200000,
+                  help="Maximum number of files kept in the cache. Least recently used are removed first. Default: %default")
+parser.add_option("--no-cache", dest="no_cache", action="store_true", default=False,
+                  help="Don't use the meta data cache. Always read files.")
+parser.add_option("--purge-cache", dest="purge_cache", action="store_true", default=False,
+                  help="Remove all entries from the meta data cache before processing")
+parser.add_option("--resume", dest="resume", action="store_true", default=False,
+                  help="Resume interrupted publication of the same list of files. Requires --publish.")
+parser.add_option("--journal", dest="journal", metavar="FILE",
+                  help="Journal file used to resume publication. By default it's derived from the list of files and stored in %s" % publication_journal.default_directory)
+parser.add_option("--local", dest="local", metavar="DIR",
+                  help="Read files from a local directory DIR/<lfn> instead of xrootd. Useful for testing.")
+parser.add_option("--redirector", dest="redirector", metavar="HOST", default=storage_module.default_redirector,
+                  help="xrootd redirector used to find files. Default: %default")
+parser.add_option("--checksums", dest="checksums", action="store_true", default=False,
+                  help="Compute adler32 and cksum checksums of files. Requires one full read of each file.")
+parser.add_option("--checksum-chunk", dest="checksum_chunk", metavar="MB", type="int", default=64,
+                  help="Size of reads used for checksum calculation. Default: %default")
+instrumentation.add_options(parser)
+governor.add_options(parser)
 
 cmssw_version = ''
 if 'CMSSW_VERSION' in os.environ:
@@ -40,39 +89,147 @@ parser.add_option("--release", dest="release", metavar="CMSSW", default=cmssw_ve
                   help="CMSSW release version. Default: %default")
 
 (options, args) = parser.parse_args()
+instrumentation.setup(options)
+governor.setup(options)
 
-if not options.file and not options.files:
+if not options.file and not options.files and not options.manifest:
      parser.print_help()
      sys.exit()
 
+if (options.manifest or options.by_directory) and (options.dataset or options.primary_ds):
+     print "ERROR: --dataset and --primary can't be used to publish several datasets"
+     sys.exit(1)
+
+if options.manifest and (options.file or options.files or options.by_directory):
+     print "ERROR: --manifest can't be combined with --file, --list or --by-directory"
+     sys.exit(1)
+
+if options.resume and not options.publish:
+     print "ERROR: --resume works only with --publish"
+     sys.exit(1)
+
 # ==========================================================================
 
-sys.argv = [] # clear up list of arguments to avoid confusing ROOT
-import ROOT, array
-ROOT.gROOT.SetBatch(True)
-
-def get_file_size(lfn):
-    (status,result) = commands.getstatusoutput("xrd cms-xrd-global.cern.ch stat %s"%lfn)
-    if status!=0: raise Exception("Failed to stat file %s using xrd"%lfn)
-    match = re.search('Size:\s*(\d+)',result)
-    if match:
-        return int(match.group(1))
-    raise Exception("Failed to get file size for file %s" % lfn)
-
-def get_nevents(lfn):
-    f = ROOT.TFile.Open('root://cms-xrd-global.cern.ch/%s'%lfn)
-    if not f: raise Exception("Failed to open file %s"%lfn)
-    tree = f.Get("Events")
-    return tree.GetEntries()
-
-def get_run_lumi_list(lfn):
-    file_lumi_list = []
-    f = ROOT.TFile.Open('root://cms-xrd-global.cern.ch/%s'%lfn)
-    tree = f.Get("LuminosityBlocks")
-    for entry in tree:
-        file_lumi_list.append({'lumi_section_num':entry.LuminosityBlockAuxiliary.luminosityBlock(),
-                               'run_num':entry.LuminosityBlockAuxiliary.run()})
-    return file_lumi_list
+del sys.argv[1:] # clear up list of arguments to avoid confusing ROOT
+import file_probe
+
+if options.local:
+     storage = storage_module.PosixStorage(options.local)
+else:
+     storage = storage_module.XRootDStorage(options.redirector)
+
+metadata_cache = None
+if not options.no_cache:
+     metadata_cache = metadata_cache_module.MetadataCache(options.cache_file, options.cache_ttl*86400,
+                                                          options.cache_max_entries)
+     if options.purge_cache:
+          metadata_cache.purge()
+
+def get_file_metadata(lfn):
+    """Get file meta data from the cache or by reading the file.
+    Returns (file_info, from_cache). Files already processed according
+    to the journal are not read again."""
+    if journal and lfn in journal.files:
+        record = journal.files[lfn]
+        lumis = file_probe.LumiRanges.from_ranges(record['lumi_ranges'])
+        return (file_probe.FileInfo(lfn, record['event_count'], record['file_size'], lumis,
+                                    record.get('adler32'), record.get('check_sum')), True)
+    if metadata_cache:
+        file_size = storage.stat(lfn)
+        cached = metadata_cache.get(lfn, file_size)
+        if cached:
+            event_count, runs, lumis = cached
+            return (file_probe.FileInfo(lfn, event_count, file_size, file_probe.LumiList(runs, lumis)), True)
+    return (file_probe.probe_file(lfn, storage), False)
+
+def get_file_info(lfn):
+    """Get file meta data and, if requested, checksums. Checksums are
+    computed in the same worker right after meta data extraction, so the
+    site resolved for the file is reused. Returns (lfn, file_info, error,
+    from_cache, new_checksums)"""
+    try:
+        info, from_cache = get_file_metadata(lfn)
+        new_checksums = False
+        if options.checksums and info.adler32 == None:
+            checksums = None
+            if metadata_cache:
+                checksums = metadata_cache.get_checksums(lfn, info.file_size)
+            if not checksums:
+                checksums = checksums_module.compute_file_checksums(lfn, storage, options.checksum_chunk*pow(2,20))
+                new_checksums = True
+            info = info._replace(adler32=checksums[0], check_sum=checksums[1])
+        return (lfn, info, None, from_cache, new_checksums)
+    except Exception, e:
+        return (lfn, None, str(e), False, False)
+
+def get_file_info_in_worker(lfn):
+    """Worker processes send their timing measurements with each result"""
+    return get_file_info(lfn), instrumentation.metrics.take()
+
+def get_dbs_file_metadata(info):
+    """DBS file meta data with lumi sections kept in compact form under
+    'lumis'. They are expanded into file_lumi_list only when the block
+    is uploaded (see make_block_dict)."""
+    lumis = info.lumis
+    if not isinstance(lumis, file_probe.LumiRanges):
+        lumis = file_probe.LumiRanges.from_lumis(lumis)
+    return {'logical_file_name':info.lfn,
+            'event_count':info.event_count,
+            'file_size':info.file_size,
+            'check_sum': info.check_sum or 'NOTSET',
+            'adler32': info.adler32 or 'deadbeef',
+            'file_type': 'EDM',
+            'lumis':lumis
+            }
+
+def get_dbs_file(file):
+    """Expand compact meta data into DBS format"""
+    dbs_file = dict(file)
+    dbs_file['file_lumi_list'] = file_probe.get_dbs_lumi_list(dbs_file.pop('lumis'))
+    return dbs_file
+
+def iterate_file_metadata(lfns, jobs, failures):
+    """Run meta data extraction for all files and yield DBS file meta data
+    in the input order as soon as it's available. Failed files are added to
+    the failures list as (lfn, error)"""
+    pool = None
+    if jobs > 1 and len(lfns) > 1:
+        # ROOT is not thread friendly, so use processes
+        # workers start without measurements inherited from the parent
+        pool = multiprocessing.Pool(min(jobs, len(lfns)), instrumentation.metrics.take)
+        def merge_metrics(results):
+            for result, worker_metrics in results:
+                instrumentation.metrics.merge(worker_metrics)
+                yield result
+        results = merge_metrics(pool.imap(get_file_info_in_worker, lfns, 1))
+    else:
+        results = itertools.imap(get_file_info, lfns)
+    nCached = 0
+    try:
+        for lfn, info, error, from_cache, new_checksums in results:
+            if error:
+                failures.append((lfn, error))
+                continue
+            if from_cache:
+                nCached += 1
+            elif metadata_cache:
+                metadata_cache.put(lfn, info.file_size, info.event_count, info.lumis.runs, info.lumis.lumis)
+            if new_checksums and metadata_cache:
+                metadata_cache.put_checksums(lfn, info.file_size, info.adler32, info.check_sum)
+            metadata = get_dbs_file_metadata(info)
+            if journal and lfn not in journal.files:
+                journal.add_file(lfn, info.event_count, info.file_size, metadata['lumis'].ranges(),
+                                 info.adler32, info.check_sum)
+            yield metadata
+    finally:
+        if pool:
+            pool.terminate()
+    if metadata_cache:
+        print "Meta data for %d out of %d files is taken from the cache" % (nCached, len(lfns))
+        metadata_cache.evict()
+
+def report_phase(name, start_time):
+     print "%s took %0.1f seconds" % (name, time.time()-start_time)
 
 def getFileName(lfn):
      match = re.search(r'([^/]+).root$',lfn)
@@ -86,12 +243,78 @@ def getDirectoryName(lfn):
           return match.group(1)
      return ""
 
-dbsWriter = DbsApi(url="https://cmsweb.cern.ch/dbs/prod/phys03/DBSWriter/")
-dbsReader = DbsApi(url="https://cmsweb.cern.ch/dbs/prod/phys03/DBSReader/")
+def read_manifest(path):
+     """Manifest lines are 'NAME LFN'. Returns an ordered dictionary NAME -> list of LFNs"""
+     groups = collections.OrderedDict()
+     seen = set()
+     with open(path) as f:
+          for line in f:
+               fields = line.split()
+               if len(fields)==0 or fields[0].startswith('#'):
+                    continue
+               if len(fields)!=2:
+                    raise Exception("Bad manifest line: %s" % line.strip())
+               name, lfn = fields
+               if lfn in seen:
+                    raise Exception("File %s is listed more than once in the manifest" % lfn)
+               seen.add(lfn)
+               groups.setdefault(name, []).append(lfn)
+     return groups
+
+def is_dataset_name(name):
+     return re.search(r'^/[^/]+/[^/]+/[^/]+$', name) != None
+
+def get_primary_dataset_name(group, files):
+     """Group is a manifest name, a directory name or None if all files are
+     published in one dataset"""
+     if options.primary_ds:
+          return options.primary_ds
+     if group != None:
+          if is_dataset_name(group):
+               return group.split('/')[1]
+          return group
+     if len(files)==1:
+          return getFileName(files[0])
+     return getDirectoryName(files[0])
+
+def get_new_dataset_names(primary_names):
+     """Dataset names with the next free version number for each primary
+     dataset. If there are several, versions of all of them are found with
+     one query."""
+     if len(primary_names)==1:
+          pattern = "/%s/%s-%s-v*/%s" % (primary_names[0],options.campaign,options.info,options.tier)
+     else:
+          pattern = "/*/%s-%s-v*/%s" % (options.campaign,options.info,options.tier)
+     maxVersions = dict()
+     # search for similar datasets and get max version
+     for ds in dbsReader.listDatasets(dataset=pattern, detail=True):
+          match = re.search(r'^/([^/]+)/.*-v(\d+)/[^/]+$',ds['dataset'])
+          if match:
+               primary, version = match.group(1), int(match.group(2))
+               maxVersions[primary] = max(version, maxVersions.get(primary, 0))
+     return dict((primary, "/%s/%s-%s-v%d/%s" % (primary,options.campaign,options.info,
+                                                  maxVersions.get(primary, 0) + 1,options.tier))
+                 for primary in primary_names)
+
+writer_url = "https://cmsweb.cern.ch/dbs/prod/phys03/DBSWriter/"
+writers = threading.local()
+
+def get_writer():
+     """DbsApi objects are not thread safe, so each upload thread has its own one"""
+     if not hasattr(writers, 'api'):
+          writers.api = dbs_tools.make_api(writer_url)
+     return writers.api
+
+dbsReader = dbs_tools.get_api("https://cmsweb.cern.ch/dbs/prod/phys03/DBSReader/")
 
 # Get files to be published
 # TODO: check that they don't belong to some dataset already
 all_files = []
+manifest = None
+if options.manifest:
+    manifest = read_manifest(options.manifest)
+    for lfns in manifest.values():
+         all_files.extend(lfns)
 if options.files:
     all_files = options.files.split(',')
 if options.file:
@@ -99,18 +322,41 @@ if options.file:
          for file in fIN:
               if re.search('\S',file):
                    all_files.append(file.strip('\n'))
-valid_files = []
+# Publication journal allows to resume interrupted publication
+journal = None
+if options.publish:
+     journal = publication_journal.PublicationJournal(options.journal or publication_journal.get_default_path(all_files))
+     if options.resume:
+          if journal.done:
+               print "Publication recorded in %s is already complete" % journal.path
+               sys.exit()
+          print "Resume publication using journal %s: %d files processed, %d files uploaded" % (
+               journal.path, len(journal.files), len(journal.uploaded_files))
+     else:
+          if len(journal.files)>0 and not journal.done:
+               print "WARNING: unfinished publication found in %s. It's discarded. Use --resume to continue it." % journal.path
+          journal.reset()
+
+phase_start = time.time()
+root_files = []
 for file in all_files:
      if not re.search(r'.root$',file): 
           print "Not a ROOT file: %s skipped" % file
           continue
-     datasets = dbsReader.listDatasets(logical_file_name=file)
-     if len(datasets)>0:
+     if journal and file in journal.uploaded_files:
+          continue
+     root_files.append(file)
+known_files = dbs_tools.find_known_files(dbsReader, root_files, options.dbs_chunk)
+valid_files = []
+for file in root_files:
+     if file in known_files:
           print "File %s is already known to DBS. Skipped" % file
-          pprint.pprint(datasets)
+          pprint.pprint(sorted(known_files[file]))
           continue
      valid_files.append(file)
 
+report_phase("File validation", phase_start)
+
 if len(valid_files)==0:
      raise Exception("Nothing to publish")
 
@@ -118,62 +364,86 @@ if options.verbose:
      print "Files to publish:"
      pprint.pprint(valid_files)
 
-# Publication dataset name
-primary_dataset_name = None
-if options.primary_ds:
-     primary_dataset_name = options.primary_ds
-else:
-     if len(valid_files)==1:
-          primary_dataset_name = getFileName(valid_files[0])
-     else:     
-          primary_dataset_name = getDirectoryName(valid_files[0])
-if not primary_dataset_name:
-     raise Exception("Failed to get primary dataset name")
-
-dataset_name = None
-if options.dataset:
-     dataset_name = options.dataset
+# Files are grouped into datasets. Without --manifest and --by-directory
+# all of them go into one dataset with group key None.
+groups = collections.OrderedDict()
+if manifest:
+     valid_set = set(valid_files)
+     for name, lfns in manifest.items():
+          files = [lfn for lfn in lfns if lfn in valid_set]
+          if len(files)>0:
+               groups[name] = files
+elif options.by_directory:
+     for file in valid_files:
+          groups.setdefault(getDirectoryName(file), []).append(file)
 else:
-     dataset_name = "/%s/%s-%s-v*/%s" % (primary_dataset_name,options.campaign,options.info,options.tier)
-     maxVersion = None
-     # search for similar datasets and get max version
-     datasets = dbsReader.listDatasets(dataset=dataset_name, detail=True)
-     for ds in datasets:
-          match = re.search(r'-v(\d+)/[^/]+$',ds['dataset'])
-          if match:
-               if not maxVersion or maxVersion < int(match.group(1)):
-                    maxVersion = int(match.group(1))
-     version = 1
-     if maxVersion:
-          version = maxVersion + 1
-     dataset_name = "/%s/%s-%s-v%d/%s" % (primary_dataset_name,options.campaign,options.info,version,options.tier)
-
-print "Dataset name: %s" % dataset_name 
+     groups[None] = valid_files
+
+# Publication dataset names
+phase_start = time.time()
+primary_names = dict()
+dataset_names = dict()
+for group, files in groups.items():
+     primary_names[group] = get_primary_dataset_name(group, files)
+     if not primary_names[group]:
+          raise Exception("Failed to get primary dataset name for %s" % (group or files[0]))
+     if options.dataset:
+          dataset_names[group] = options.dataset
+     elif group != None and is_dataset_name(group):
+          dataset_names[group] = group
+     elif journal and journal.datasets.get(group):
+          dataset_names[group] = journal.datasets[group]
+
+new_datasets = set()
+unresolved = [group for group in groups if group not in dataset_names]
+if len(unresolved)>0:
+     new_names = get_new_dataset_names(sorted(set([primary_names[group] for group in unresolved])))
+     for group in unresolved:
+          dataset_names[group] = new_names[primary_names[group]]
+          new_datasets.add(dataset_names[group])
+
+for group in groups:
+     dataset_name = dataset_names[group]
+     print "Dataset name: %s" % dataset_name
+     if journal and journal.datasets.get(group) != dataset_name:
+          journal.set_dataset(dataset_name, group)
 
 # =======================================================================================================
 
-empty, primary_ds_name, proc_name, ds_tier =  dataset_name.split('/')
-
-# Find files already published in this dataset.
-existingDBSFiles = dbsReader.listFiles(dataset = dataset_name, detail = True)
-existingFiles = [f['logical_file_name'] for f in existingDBSFiles]
-existingFilesValid = [f['logical_file_name'] for f in existingDBSFiles if f['is_file_valid']]
-if len(existingFiles)>0:
-     print "Dataset %s already contains %d files" % (dataset_name, len(existingFiles)),
-     print " (%d valid, %d invalid)." % (len(existingFilesValid), len(existingFiles) - len(existingFilesValid))
-
-# Get a list of files that need to be acted on
-files_to_publish = []
+# Find files already published in the datasets and get a list of files
+# that need to be acted on. Datasets with a new version number have no
+# files yet.
+publications = []    # (dataset name, files to publish)
 files_to_change_status = []
-for file in valid_files:
-    if file not in existingFiles:
-        files_to_publish.append(file)
-    elif file not in existingFilesValid:
-        files_to_change_status.append(file)
-if len(files_to_publish)==0 and len(files_to_change_status)==0:
+for group, files in groups.items():
+     dataset_name = dataset_names[group]
+     existingFiles = set()
+     existingFilesValid = set()
+     if dataset_name not in new_datasets:
+          existingDBSFiles = dbsReader.listFiles(dataset = dataset_name, detail = True)
+          existingFiles = set([f['logical_file_name'] for f in existingDBSFiles])
+          existingFilesValid = set([f['logical_file_name'] for f in existingDBSFiles if f['is_file_valid']])
+     if len(existingFiles)>0:
+          print "Dataset %s already contains %d files" % (dataset_name, len(existingFiles)),
+          print " (%d valid, %d invalid)." % (len(existingFilesValid), len(existingFiles) - len(existingFilesValid))
+     files_to_publish = []
+     for file in files:
+         if file not in existingFiles:
+             files_to_publish.append(file)
+         elif file not in existingFilesValid:
+             files_to_change_status.append(file)
+     if len(files_to_publish)>0:
+          publications.append((dataset_name, files_to_publish))
+nFilesToPublish = sum([len(files) for dataset_name, files in publications])
+report_phase("Dataset lookup in DBS", phase_start)
+if nFilesToPublish==0 and len(files_to_change_status)==0:
     print "Everything is already published and up to date"
+    if journal: journal.set_done()
     sys.exit()
-print "Found %d files not already present in DBS which will be published." % len(files_to_publish)
+if len(groups)>1:
+     print "Found %d files not already present in DBS which will be published in %d datasets." % (nFilesToPublish, len(publications))
+else:
+     print "Found %d files not already present in DBS which will be published." % nFilesToPublish
 print "Found %d files that require status change." % len(files_to_change_status)
 
 
@@ -189,20 +459,6 @@ output_config = {'release_version': cmssw_version,
                  'global_tag': 'NoTag',
                  }
 
-dataset_config = {'dataset': dataset_name,
-                  'processed_ds_name': proc_name,
-                  'data_tier_name': ds_tier,
-                  'dataset_access_type': 'VALID', 
-                  'physics_group_name': 'NoGroup',
-                  'last_modification_date': int(time.time()),
-                  }
-
-block_name = "%s#%s" % (dataset_name, str(uuid.uuid4()))
-
-block_config = {'block_name': block_name, 
-                'origin_site_name': 'T2_CH_CERN', 
-                'open_for_writing': 0}
-
 acquisition_era_config = {
     'acquisition_era_name':campaign, 
     'start_date':0
@@ -211,55 +467,132 @@ processing_era_config = {
     'processing_version': 1, 
     'description': 'LHE_Injection'
 }
-primds_config = {
-    'primary_ds_type': 'mc', 
-    'primary_ds_name': primary_ds_name
-}
 
-files = []
-for lfn in files_to_publish:
-    file = {'logical_file_name':lfn,
-            'event_count':get_nevents(lfn),
-            'file_size':get_file_size(lfn),
-            'check_sum': 'NOTSET',
-            'adler32':'deadbeef',
-            'file_type': 'EDM',
-            'file_lumi_list':get_run_lumi_list(lfn)
+def get_dataset_config(dataset_name):
+    empty, primary_ds_name, proc_name, ds_tier =  dataset_name.split('/')
+    return {'dataset': dataset_name,
+            'processed_ds_name': proc_name,
+            'data_tier_name': ds_tier,
+            'dataset_access_type': 'VALID', 
+            'physics_group_name': 'NoGroup',
+            'last_modification_date': int(time.time()),
             }
-    files.append(file)
-            
-  
-blockDict = {
-    'dataset_conf_list': [output_config],
-    'file_conf_list': [],
-    'files': files,
-    'processing_era': processing_era_config,
-    'primds': primds_config,
-    'dataset': dataset_config,
-    'acquisition_era': acquisition_era_config,
-    'block': block_config,
-    'file_parent_list': []
-    }
-
-blockDict['block']['file_count'] = len(files)
-blockDict['block']['block_size'] = sum([int(file['file_size']) for file in files])
 
-if options.verbose:
-     pprint.pprint(blockDict)
+def get_primds_config(dataset_name):
+    return {'primary_ds_type': 'mc', 
+            'primary_ds_name': dataset_name.split('/')[1]}
+
+def make_block_config(files, dataset_name):
+    return {'block_name': "%s#%s" % (dataset_name, str(uuid.uuid4())),
+            'origin_site_name': 'T2_CH_CERN', 
+            'open_for_writing': 0,
+            'file_count': len(files),
+            'block_size': sum([int(file['file_size']) for file in files])}
+
+def make_block_dict(block_config, files, dataset_name):
+    """Bulk block payload. Lumi lists are expanded here, so that only one
+    block at a time exists in the verbose DBS format."""
+    return {
+        'dataset_conf_list': [output_config],
+        'file_conf_list': [],
+        'files': [get_dbs_file(file) for file in files],
+        'processing_era': processing_era_config,
+        'primds': get_primds_config(dataset_name),
+        'dataset': get_dataset_config(dataset_name),
+        'acquisition_era': acquisition_era_config,
+        'block': block_config,
+        'file_parent_list': []
+        }
+
+def process_block(files, dataset_name):
+    """Upload a block of files as soon as it's complete. Returns True on success"""
+    block_config = make_block_config(files, dataset_name)
+    block_name = block_config['block_name']
+    print "Block %s: %d files, %0.1f GB" % (block_name, len(files), block_config['block_size']/pow(2.,30))
+    if options.verbose:
+        # the full payload is too large to be printed
+        for file in files:
+            print "\t%s: %d events, %d bytes, %d lumis in %d ranges" % (
+                file['logical_file_name'], file['event_count'], file['file_size'],
+                len(file['lumis']), len(file['lumis'].runs))
+    if not options.publish:
+        return True
+    blockDict = make_block_dict(block_config, files, dataset_name)
+    lfns = [file['logical_file_name'] for file in files]
+    journal.set_block_status(block_name, lfns, 'uploading')
+    try:
+        get_writer().insertBulkBlock(blockDict)
+    except HTTPError, he:
+        print he
+        journal.set_block_status(block_name, lfns, 'failed')
+        return False
+    journal.set_block_status(block_name, lfns, 'uploaded')
+    return True
+
+if options.publish:
+     # Insert primary dataset names, each one once. It's safe to do it for already existing primary datasets
+     for primary_ds_name in sorted(set([dataset_name.split('/')[1] for dataset_name, files in publications])):
+          get_writer().insertPrimaryDataset({'primary_ds_name': primary_ds_name, 'primary_ds_type': 'mc'})
+
+# Files are grouped in blocks limited by number of files and size. A block
+# is uploaded as soon as meta data for all its files is ready. Meta data
+# of all datasets is extracted by one pool of workers, so files of the
+# next dataset are processed while blocks of the previous one are uploaded.
+phase_start = time.time()
+failed_files = []
+failed_blocks = []
+nBlocks = 0
+upload_pool = None
+if options.upload_jobs > 1:
+     upload_pool = ThreadPool(options.upload_jobs)
+pending_uploads = []   # (lfns, result) in submission order
+
+def wait_for_uploads(max_pending):
+     while len(pending_uploads) > max_pending:
+          lfns, result = pending_uploads.pop(0)
+          # wait with timeout to stay responsive to Ctrl-C
+          while not result.ready():
+               result.wait(1)
+          if not result.get():
+               failed_blocks.append(lfns)
+
+file_datasets = dict()
+for dataset_name, files in publications:
+     for file in files:
+          file_datasets[file] = dataset_name
+files = iterate_file_metadata([file for dataset_name, files in publications for file in files],
+                              options.jobs, failed_files)
+for dataset_name, dataset_files in itertools.groupby(files, lambda file: file_datasets[file['logical_file_name']]):
+     for block_files in dbs_tools.split_in_blocks(dataset_files, options.max_files_per_block, options.max_block_size*pow(2,30)):
+          nBlocks += 1
+          lfns = [f['logical_file_name'] for f in block_files]
+          if upload_pool:
+               pending_uploads.append((lfns, upload_pool.apply_async(process_block, (block_files, dataset_name))))
+               # limit the number of complete blocks kept in memory
+               wait_for_uploads(2*options.upload_jobs)
+          elif not process_block(block_files, dataset_name):
+               failed_blocks.append(lfns)
+wait_for_uploads(0)
+if upload_pool:
+     upload_pool.close()
+report_phase("Meta data extraction and upload of %d blocks for %d files" % (nBlocks, nFilesToPublish), phase_start)
+
+if len(failed_files)>0:
+     print "Failed to extract meta data for %d files:" % len(failed_files)
+     for lfn, error in failed_files:
+          print "\t%s: %s" % (lfn, error)
+if len(failed_blocks)>0:
+     print "Failed to upload %d blocks with %d files" % (len(failed_blocks), sum([len(b) for b in failed_blocks]))
 
 if not options.publish:
      print "Dry run ended. Please use --publish option if you want to publish files in DBS"
+     if len(failed_files)>0: sys.exit(1)
      sys.exit()
 
-# Insert primary dataset name. It's safe to do it for already existing primary datasets
-primds_config = {'primary_ds_name': primary_ds_name, 'primary_ds_type': 'mc'}
-dbsWriter.insertPrimaryDataset(primds_config)
-
-# Insert block of files
-try:
-    dbsWriter.insertBulkBlock(blockDict)
-except HTTPError, he:
-    print he
+if len(failed_files)>0 or len(failed_blocks)>0:
+     print "Not all files are published. Use --resume to publish remaining files in the same datasets"
+     sys.exit(1)
+journal.set_done()
 
 # 
 # Info
@@ -284,5 +617,4 @@ except HTTPError, he:
 # acquisition_era_name 
 # release_version $CMSSW_VERSION 
 # global_tag
-# max_files_per_block
 
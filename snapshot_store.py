@@ -0,0 +1,61 @@
+"""
+Persistent store of per-dataset consistency check results. It keeps the
+DBS last modification date, the dataset size and the subscription
+summary of every checked dataset, so that the next check can skip
+datasets that didn't change and report what changed since.
+
+Status of a dataset is a comma separated list of problems found
+(NotInPhedex, NoCompleteCopyAnywhere, Lost, NoCompleteCopyAnalysisOps),
+'OK' if there are none or 'Skipped' if the check was skipped.
+"""
+import os, time, json, sqlite3
+
+class SnapshotStore(object):
+     def __init__(self, path):
+          self.path = path
+          directory = os.path.dirname(path)
+          if directory and not os.path.exists(directory):
+               os.makedirs(directory)
+          self.db = sqlite3.connect(path)
+          self.db.execute("""CREATE TABLE IF NOT EXISTS datasets (
+                                  dataset TEXT PRIMARY KEY,
+                                  last_modification_date INTEGER,
+                                  size INTEGER,
+                                  status TEXT,
+                                  report TEXT,
+                                  checked REAL)""")
+          self.db.commit()
+
+     def load(self):
+          """Returns dictionary dataset -> record of the last snapshot"""
+          records = dict()
+          for row in self.db.execute("SELECT dataset, last_modification_date, size, status, report, checked FROM datasets"):
+               records[row[0]] = {'last_modification_date':row[1], 'size':row[2], 'status':row[3],
+                                  'report':json.loads(row[4]), 'checked':row[5]}
+          return records
+
+     def update(self, dataset, last_modification_date, size, status, report):
+          self.db.execute("INSERT OR REPLACE INTO datasets VALUES (?,?,?,?,?,?)",
+                          (dataset, last_modification_date, size, status, json.dumps(report), time.time()))
+
+     def remove(self, datasets):
+          self.db.executemany("DELETE FROM datasets WHERE dataset=?", [(ds,) for ds in datasets])
+
+     def commit(self):
+          self.db.commit()
+
+def get_changes(previous, current):
+     """Compare dataset statuses. Returns sorted list of (dataset, old, new),
+     where old is None for new datasets and new is None for datasets that
+     are gone."""
+     changes = []
+     for dataset, status in current.items():
+          if dataset not in previous:
+               changes.append((dataset, None, status))
+          elif previous[dataset]['status'] != status:
+               changes.append((dataset, previous[dataset]['status'], status))
+     for dataset in previous:
+          if dataset not in current:
+               changes.append((dataset, previous[dataset]['status'], None))
+     changes.sort()
+     return changes
@@ -0,0 +1,160 @@
+"""
+Access to files by logical file name (LFN). Two backends are available:
+
+  XRootDStorage - remote access through an xrootd redirector. The site
+                  serving a directory is resolved once and later files
+                  from the same directory are accessed at that site
+                  directly, reusing the same xrootd session. After
+                  a failure the directory is accessed through the
+                  redirector.
+  PosixStorage  - files on a local file system under a prefix
+                  directory. Useful for testing without network access.
+"""
+import os, re, time, commands, subprocess
+import instrumentation
+
+try:
+     from XRootD import client as xrootd_client
+     from XRootD.client.flags import OpenFlags
+except ImportError:
+     # fall back to command line tools
+     xrootd_client = None
+
+default_redirector = "cms-xrd-global.cern.ch"
+
+class PosixStorage(object):
+     def __init__(self, prefix):
+          self.prefix = prefix
+
+     def url(self, lfn):
+          return os.path.join(self.prefix, lfn.lstrip('/'))
+
+     def stat(self, lfn):
+          with instrumentation.timed("posix.stat"):
+               return os.path.getsize(self.url(lfn))
+
+     def failed(self, lfn):
+          """Nothing to retry for local files"""
+          return False
+
+     def read_chunks(self, lfn, chunk_size):
+          """Read the whole file sequentially"""
+          with open(self.url(lfn), 'rb') as f:
+               while True:
+                    with instrumentation.timed("posix.read") as call:
+                         data = f.read(chunk_size)
+                         call['bytes'] = len(data)
+                    if not data: break
+                    yield data
+
+class XRootDStorage(object):
+     def __init__(self, redirector=default_redirector):
+          self.redirector = redirector
+          self.sites = dict()      # directory -> host serving files
+          self.sessions = dict()   # host -> xrootd FileSystem
+
+     def _session(self, host):
+          if host not in self.sessions:
+               self.sessions[host] = xrootd_client.FileSystem("root://%s" % host)
+          return self.sessions[host]
+
+     def _locate(self, lfn):
+          """Ask the redirector which data server has the file"""
+          if not xrootd_client:
+               return None
+          with instrumentation.timed("xrootd.locate"):
+               status, locations = self._session(self.redirector).deeplocate(lfn, OpenFlags.NONE)
+          if not status.ok or not locations:
+               return None
+          for location in locations:
+               return location.address
+          return None
+
+     def resolve(self, lfn):
+          """Host to be used to access the file"""
+          directory = os.path.dirname(lfn)
+          if directory not in self.sites:
+               self.sites[directory] = self._locate(lfn) or self.redirector
+          return self.sites[directory]
+
+     def failed(self, lfn):
+          """Use the redirector instead of the site resolved for the file
+          directory. Locating the file again could return the same broken
+          server. Returns True if another attempt through the redirector
+          makes sense."""
+          directory = os.path.dirname(lfn)
+          host = self.sites.get(directory)
+          self.sites[directory] = self.redirector
+          return host != None and host != self.redirector
+
+     def url(self, lfn):
+          return "root://%s/%s" % (self.resolve(lfn), lfn)
+
+     def read_chunks(self, lfn, chunk_size):
+          """Read the whole file sequentially from the resolved site"""
+          if not xrootd_client:
+               for data in self._read_chunks_xrdcp(lfn, chunk_size):
+                    yield data
+               return
+          f = xrootd_client.File()
+          with instrumentation.timed("xrootd.open"):
+               status, response = f.open(self.url(lfn))
+          if not status.ok and self.failed(lfn):
+               with instrumentation.timed("xrootd.open"):
+                    status, response = f.open(self.url(lfn))
+          if not status.ok:
+               raise Exception("Failed to open file %s: %s" % (lfn, status.message))
+          try:
+               offset = 0
+               while True:
+                    start = time.time()
+                    status, data = f.read(offset, chunk_size)
+                    instrumentation.metrics.record("xrootd.read", time.time()-start, len(data or ""), not status.ok)
+                    if not status.ok:
+                         raise Exception("Failed to read file %s: %s" % (lfn, status.message))
+                    if not data: break
+                    offset += len(data)
+                    yield data
+          finally:
+               f.close()
+
+     def _read_chunks_xrdcp(self, lfn, chunk_size):
+          process = subprocess.Popen(["xrdcp", "-s", self.url(lfn), "-"], stdout=subprocess.PIPE)
+          try:
+               while True:
+                    with instrumentation.timed("xrootd.read") as call:
+                         data = process.stdout.read(chunk_size)
+                         call['bytes'] = len(data)
+                    if not data: break
+                    yield data
+          except:
+               # the consumer stopped early or failed. xrdcp would fail on
+               # the closed pipe, its exit code must not hide the reason.
+               process.kill()
+               process.stdout.close()
+               process.wait()
+               raise
+          process.stdout.close()
+          if process.wait() != 0:
+               raise Exception("Failed to read file %s using xrdcp" % lfn)
+
+     def stat(self, lfn):
+          host = self.resolve(lfn)
+          if xrootd_client:
+               while True:
+                    start = time.time()
+                    status, info = self._session(host).stat(lfn)
+                    instrumentation.metrics.record("xrootd.stat", time.time()-start, error=not status.ok)
+                    if status.ok:
+                         return info.size
+                    # one more attempt through the redirector
+                    if not self.failed(lfn):
+                         raise Exception("Failed to stat file %s: %s" % (lfn, status.message))
+                    host = self.resolve(lfn)
+          with instrumentation.timed("xrootd.stat"):
+               (status,result) = commands.getstatusoutput("xrd %s stat %s" % (host, lfn))
+          if status!=0: raise Exception("Failed to stat file %s using xrd"%lfn)
+          match = re.search('Size:\s*(\d+)',result)
+          if match:
+               return int(match.group(1))
+          raise Exception("Failed to get file size for file %s" % lfn)